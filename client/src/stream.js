@@ -9,6 +9,82 @@ define([
 
     var Stream = function(app) {};
 
+    Stream.refreshCharacter = function(updateData) {
+        var charId = updateData.id;
+        if (app.characters.hasOwnProperty(charId)) {
+            app.characters[charId].model.refreshData(updateData);
+        } else {
+            app.characters[charId] = {};
+            app.characters[charId].model = new app.CharacterModel(updateData);
+            app.characters[charId].sprite = new app.SpriteView({
+                model: app.characters[charId].model
+            });
+        }
+    };
+    Stream.removeCharacter = function(removeId) {
+        if (app.characters.hasOwnProperty(removeId)) {
+            for (var key in app.characters[removeId]) {
+                app.characters[removeId][key].destroy();
+            }
+            delete app.characters[removeId];
+        }
+    };
+    Stream.refreshTurret = function(data) {
+        if (!app.turrets[data.id]) {
+            app.turrets[data.id] = new app.TurretModel(data);
+        }
+        app.turrets[data.id].data = data;
+        app.turrets[data.id].refreshData(data);
+    };
+    Stream.removeTurret = function(removeId) {
+        if (app.turrets[removeId]) {
+            app.stage.removeChild(app.turrets[removeId].shape);
+            app.stage.removeChild(app.turrets[removeId].line);
+            delete app.turrets[removeId];
+        }
+    };
+
+    // states of the last applied snapshots by seq, the server sends
+    // deltas against the last one we acknowledged, which may be a few
+    // frames behind the one shown
+    Stream.STATES = 64;
+    Stream.states = {};
+    Stream.seqs = [];
+    Stream.shown = {users: {}, turrets: {}};
+
+    Stream.applySnapshot = function(data) {
+        var base = data.full ? {} : Stream.states[data.base];
+        if (!base) return null;
+        var state = {};
+        _.each(['users', 'turrets'], function(section) {
+            var entities = _.clone(base[section] || {});
+            var changes = data[section];
+            var i, entity;
+            for (i = 0; i < changes.add.length; i++) {
+                entities[changes.add[i].id] = changes.add[i];
+            }
+            for (i = 0; i < changes.update.length; i++) {
+                entity = changes.update[i];
+                if (entities.hasOwnProperty(entity.id)) {
+                    entities[entity.id] = _.extend(
+                        {}, entities[entity.id], entity);
+                }
+            }
+            for (i = 0; i < changes.remove.length; i++) {
+                delete entities[changes.remove[i]];
+            }
+            state[section] = entities;
+        });
+        if (!Stream.states.hasOwnProperty(data.seq)) {
+            Stream.seqs.push(data.seq);
+            while (Stream.seqs.length > Stream.STATES) {
+                delete Stream.states[Stream.seqs.shift()];
+            }
+        }
+        Stream.states[data.seq] = state;
+        return state;
+    };
+
     Stream.send = function(msgType, data) {
         var jData = JSON.stringify({
             'msg_type': msgType,
@@ -48,44 +124,75 @@ define([
                 app.characters[data.id].vision = new WeaponVisionView({app: app});
             });
             ws.on('users_map', function(data) {
-                var charId, updateData;
                 if (app.currentCharacter) {
                     app.currentCharacter.hud.trigger('updateOnline', data.count);
                 }
 
                 for (var j = 0; j < data.users.update.length; j++) {
-                    charId = data.users.update[j].id;
-                    updateData = data.users.update[j];
-
-                    if (app.characters.hasOwnProperty(charId)) {
-                        app.characters[charId].model.refreshData(updateData);
-                    } else {
-                        app.characters[charId] = {};
-                        app.characters[charId].model = new app.CharacterModel(updateData);
-                        app.characters[charId].sprite = new app.SpriteView({
-                            model: app.characters[charId].model
-                        });  
-                    }
+                    Stream.refreshCharacter(data.users.update[j]);
                 }
                 for (var i = 0; i < data.users.remove.length; i++) {
-                    var removeId = data.users.remove[i];
-                    if (app.characters.hasOwnProperty(removeId)) {
-                        for (var key in app.characters[removeId]) {
-                            app.characters[removeId][key].destroy();
+                    Stream.removeCharacter(data.users.remove[i]);
+                }
+                for (var k = 0; k < data.ai.turrets.length; k++) {
+                    Stream.refreshTurret(data.ai.turrets[k]);
+                }
+                if (data.ai.remove) {
+                    for (var r = 0; r < data.ai.remove.length; r++) {
+                        Stream.removeTurret(data.ai.remove[r]);
+                    }
+                }
+            });
+            ws.on('world_snapshot', function(data) {
+                var state = Stream.applySnapshot(data);
+                // deltas against a baseline we no longer hold are useless,
+                // older frames only serve as baselines
+                if (!state || data.seq <= app.snapshotSeq) return;
+
+                if (app.currentCharacter) {
+                    app.currentCharacter.hud.trigger('updateOnline', data.count);
+                }
+                var shown = Stream.shown;
+                var id;
+                if (data.full) {
+                    shown = {users: {}, turrets: {}};
+                    for (id in app.characters) {
+                        if (!state.users.hasOwnProperty(id)) {
+                            Stream.removeCharacter(id);
+                        }
+                    }
+                    for (id in app.turrets) {
+                        if (!state.turrets.hasOwnProperty(id)) {
+                            Stream.removeTurret(id);
                         }
-                        delete app.characters[removeId];
                     }
                 }
-                for (var k = 0; k < data.ai.turrets.length; k++) {
-                    var turrets = data.ai.turrets;
-                    charId = turrets[k].target;
-                    if (!app.turrets[turrets[k].id]) {
-                        app.turrets[turrets[k].id] = new app.TurretModel(turrets[k]);                       
+                // the delta may be against an older state than the shown
+                // one, so compare the whole states
+                for (id in shown.users) {
+                    if (!state.users.hasOwnProperty(id)) {
+                        Stream.removeCharacter(id);
+                    }
+                }
+                for (id in state.users) {
+                    if (state.users[id] !== shown.users[id]) {
+                        Stream.refreshCharacter(state.users[id]);
                     }
-                    if (app.turrets[turrets[k].id]) {
-                        app.turrets[turrets[k].id].refreshData(turrets[k]);
+                }
+                for (id in shown.turrets) {
+                    if (!state.turrets.hasOwnProperty(id)) {
+                        Stream.removeTurret(id);
                     }
                 }
+                for (id in state.turrets) {
+                    if (state.turrets[id] !== shown.turrets[id]) {
+                        Stream.refreshTurret(state.turrets[id]);
+                    }
+                }
+
+                Stream.shown = state;
+                app.snapshotSeq = data.seq;
+                Stream.send('snapshot_ack', {'seq': data.seq});
             });
         };
         ws.onerror = function(evt) {
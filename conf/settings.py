@@ -4,7 +4,74 @@ DEBUG = True
 TEMPLATE_DEBUG = True
 GAME = {
     'FPS': 60,
-    'CELL_SIZE': 32
+    'CELL_SIZE': 32,
+    # px, a loaded TMX map brings its own
+    'MAP_SIZE': {'width': 1280, 'height': 768},
+    # the map is simulated by regions of REGION_SIZE px, the ones with no
+    # characters in or next to them sleep REGION_SLEEP seconds after the
+    # last one left
+    'REGION_SIZE': 512,
+    'REGION_SLEEP': 5,
+    # px per step of the walking characters and the pathfinding grid
+    'FOOTPACE': 2,
+    # seconds a character may get no closer to its next waypoint before
+    # it takes a detour around the bodies near it, it gives up the walk
+    # when stuck again
+    'BLOCKED_WAIT': 2,
+    # what the simulation does when it falls behind: 'catch_up' runs the
+    # missed ticks (at most MAX_CATCH_UP at once), 'skip' drops them
+    'TICK_POLICY': 'catch_up',
+    'MAX_CATCH_UP': 5,
+    # seconds between tick budget overrun reports
+    'TICK_REPORT': 5
+}
+PATHFINDING = {
+    # computed paths kept per (start, goal, chopped directions, algorithm),
+    # all of them are dropped when the collision map changes
+    'CACHE_SIZE': 512,
+    # where the paths of moving characters are searched: 'inline' - in
+    # the greenlet handling the move, 'processes' - in WORKERS processes,
+    # 'sliced' - by the simulation ticks, at most SLICE nodes of a search
+    # and BUDGET nodes of all of them per tick, no new slice after
+    # SLICE_TIME seconds of the tick, 'replanning' - D* Lite
+    # searches repaired when bodies get within two BODY_RADIUS px of the
+    # way, both sliced the same way, a search going past REPLAN_LIMIT
+    # times the nodes of the grid is left to a sliced A* one
+    'PLANNER': 'inline',
+    'WORKERS': 2,
+    'SLICE': 250,
+    'BUDGET': 1000,
+    'SLICE_TIME': 0.004,
+    'BODY_RADIUS': 8,
+    'REPLAN_LIMIT': 2,
+    # nodes a D* Lite repair may take before the old path is kept
+    'REPAIR_LIMIT': 20000,
+    # nodes of the A* search of a detour around the bodies holding a
+    # character up
+    'DETOUR_LIMIT': 3000,
+    # 'A*', 'BFS', 'HPA*', 'JPS', 'D*' or 'FLOW' - flow fields shared by
+    # all the characters going to the same cell
+    'ALGORITHM': 'A*',
+    # walk straight between the corners of the found paths instead of
+    # every footpace of them
+    'SMOOTH': True,
+    # flow fields kept at most and seconds they are kept unused
+    'FLOW_FIELDS': 16,
+    'FLOW_FIELD_TTL': 30
+}
+NETWORK = {
+    # 'full' - whole users_map every tick, 'delta' - sequenced snapshots
+    # with deltas against the last acknowledged one
+    'SNAPSHOTS': 'delta',
+    'SNAPSHOT_HISTORY': 64,
+    'BROADCAST_RATE': 30,
+    # area of interest: clients only get entities within AOI_RADIUS px of
+    # their character, None means the range of its best weapon plus
+    # AOI_MARGIN
+    'AOI': True,
+    'AOI_RADIUS': None,
+    'AOI_MARGIN': 200,
+    'AOI_CELL_SIZE': 128
 }
 
 PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
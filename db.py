@@ -41,10 +41,7 @@ class DBClient(object):
 
     def _local_connector(self):
         return {
-            'map_size': {
-                'width': 1280,
-                'height': 768
-            },
+            'map_size': dict(settings.GAME['MAP_SIZE']),
             '_char_greenlets': {}
         }
 
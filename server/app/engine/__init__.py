@@ -1,3 +1,18 @@
-from .colliders import CollisionManager, spatial_hash
-from .pathfindings import Pathfinder
+from .broadphase import SweepAndPrune
+from .caches import LRUCache
+from .clusters import ClusterGraph, cluster_graph
+from .colliders import (
+    CollisionManager, UniformGrid, spatial_hash, bodies_hash, index_bodies)
+from .flowfields import FlowField, FlowFields, flow_fields
+from .grids import PassabilityGrid, passability
+from .loop import GameLoop, game_loop
+from .maps import CompiledMap, MapObject, compile_map, load_map
+from .metrics import metrics
+from .movements import MovementSystem, movement
+from .pathfindings import Pathfinder, path_cache
+from .planners import (
+    PathPlanner, ProcessPlanner, SlicedPlanner, Replanner, planner)
+from .projectiles import Projectile, ProjectileSystem, projectiles
+from .regions import Region, World, world
+from .replanners import DStarLite
 from .tiles import TiledReader
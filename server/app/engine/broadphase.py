@@ -0,0 +1,48 @@
+"""Broadphase of the body vs body collisions, sweep and prune on x
+"""
+from __future__ import division
+
+from conf import settings
+
+
+class SweepAndPrune(object):
+    """Finds the pairs of bodies closer than two ``radius`` px.
+
+    Bodies are kept sorted by x between the calls. They move little in a
+    tick, so the order of the last call is nearly right and an insertion
+    sort puts it right in about one pass. Sweeping along the sorted bodies
+    only compares the ones whose x are within reach of each other.
+    """
+
+    def __init__(self, radius=settings.PATHFINDING['BODY_RADIUS']):
+        self.radius = radius
+        self.order = []
+
+    def pairs(self, positions):
+        """``[(a, b)]`` of the overlapping bodies of ``{key: (x, y)}``"""
+        order = [key for key in self.order if key in positions]
+        known = set(order)
+        order.extend(key for key in positions if key not in known)
+        for n in range(1, len(order)):
+            key = order[n]
+            x = positions[key][0]
+            m = n - 1
+            while m >= 0 and positions[order[m]][0] > x:
+                order[m + 1] = order[m]
+                m -= 1
+            order[m + 1] = key
+        self.order = order
+
+        reach = 2 * self.radius
+        reach_sq = reach * reach
+        pairs = []
+        for n, a in enumerate(order):
+            ax, ay = positions[a]
+            for m in range(n + 1, len(order)):
+                b = order[m]
+                bx, by = positions[b]
+                if bx - ax >= reach:
+                    break
+                if (bx - ax) ** 2 + (by - ay) ** 2 < reach_sq:
+                    pairs.append((a, b))
+        return pairs
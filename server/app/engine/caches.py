@@ -0,0 +1,75 @@
+"""Bounded caches of derived map data
+"""
+from collections import OrderedDict
+
+from .metrics import metrics
+
+
+class LRUCache(object):
+    """Least recently used cache bound to a version of the map.
+
+    Every lookup passes the version the caller is looking at, when it
+    differs from the one the entries were computed for the whole cache
+    is dropped. Hits and misses are counted in ``metrics`` under ``name``.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, version, default=None, convert=None):
+        """Entry of ``key``, passed through ``convert`` when given. An
+        entry it turns into ``None`` is of no use and counts as a miss.
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self._count(hit=False)
+            return default
+        self._entries[key] = value
+        if convert is not None:
+            value = convert(value)
+            if value is None:
+                self._count(hit=False)
+                return default
+        self._count(hit=True)
+        return value
+
+    def put(self, key, version, value):
+        if version != self.version:
+            self.clear()
+            self.version = version
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+            metrics.incr('%s.hits' % self.name)
+        else:
+            self.misses += 1
+            metrics.incr('%s.misses' % self.name)
+        metrics.gauge('%s.hit_rate' % self.name, round(self.hit_rate, 3))
@@ -0,0 +1,235 @@
+"""Hierarchical pathfinding (HPA*) over CELL_SIZE clusters
+"""
+from __future__ import division
+
+import heapq
+import math
+
+from conf import settings
+
+from .grids import passability
+
+
+SQRT2 = math.sqrt(2)
+
+# a border run of open nodes longer than this gets two entrances, one at
+# each end, instead of a single one in the middle
+MAX_SINGLE_ENTRANCE = 6
+
+
+def octile(a, b):
+    dx = abs(a[0] - b[0])
+    dy = abs(a[1] - b[1])
+    return dx + dy + (SQRT2 - 2) * min(dx, dy)
+
+
+class ClusterGraph(object):
+    """Abstract graph over the nodes of a ``PassabilityGrid``.
+
+    The grid is split into square clusters of ``cell_size`` px. Entrances
+    are found along every cluster border when the grid changes, the paths
+    inside a cluster are searched on demand and cached by the passability
+    of the cluster, so all the identical (e.g. open) clusters share them.
+
+    Moves are ``(di, dj, cost)`` tuples in node units.
+    """
+
+    def __init__(self, grid=passability,
+                 cell_size=settings.GAME['CELL_SIZE']):
+        self.grid = grid
+        self.cell_size = cell_size
+        self.expanded = 0
+        self._key = None
+
+    def ensure(self):
+        self.grid.ensure()
+        if self.grid._key != self._key:
+            self.build()
+            self._key = self.grid._key
+        return self
+
+    def build(self):
+        grid = self.grid
+        self.size = size = max(1, int(self.cell_size // grid.step))
+        self.cols = -(-grid.width // size)
+        self.rows = -(-grid.height // size)
+        self.entrances = {}
+        self.partners = {}
+        self._signatures = {}
+        self._trees = {}
+        for cy in range(self.rows):
+            for cx in range(self.cols):
+                if cx + 1 < self.cols:
+                    self._scan_border((cx, cy), (cx + 1, cy))
+                if cy + 1 < self.rows:
+                    self._scan_border((cx, cy), (cx, cy + 1))
+
+    def cluster_of(self, node):
+        return (node[0] // self.size, node[1] // self.size)
+
+    def bounds(self, cluster):
+        i0 = cluster[0] * self.size
+        j0 = cluster[1] * self.size
+        return (i0, j0, min(self.grid.width, i0 + self.size),
+                min(self.grid.height, j0 + self.size))
+
+    def in_grid(self, node):
+        return (0 <= node[0] < self.grid.width and
+                0 <= node[1] < self.grid.height)
+
+    def _open(self, i, j):
+        return self.grid.cells[j * self.grid.width + i] == 1
+
+    def _scan_border(self, first, second):
+        i0, j0, i1, j1 = self.bounds(first)
+        if second[0] != first[0]:
+            # vertical border, walk down the last column of ``first``
+            line = [((i1 - 1, j), (i1, j)) for j in range(j0, j1)]
+        else:
+            line = [((i, j1 - 1), (i, j1)) for i in range(i0, i1)]
+
+        run = []
+        for pair in line + [None]:
+            if pair is not None and all(self._open(*n) for n in pair):
+                run.append(pair)
+                continue
+            if not run:
+                continue
+            if len(run) < MAX_SINGLE_ENTRANCE:
+                transitions = [run[len(run) // 2]]
+            else:
+                transitions = [run[0], run[-1]]
+            for a, b in transitions:
+                self.entrances.setdefault(first, set()).add(a)
+                self.entrances.setdefault(second, set()).add(b)
+                self.partners.setdefault(a, set()).add(b)
+                self.partners.setdefault(b, set()).add(a)
+            run = []
+
+    def _signature(self, cluster):
+        try:
+            return self._signatures[cluster]
+        except KeyError:
+            i0, j0, i1, j1 = self.bounds(cluster)
+            width = self.grid.width
+            cells = self.grid.cells
+            signature = (i1 - i0, j1 - j0, b''.join(
+                bytes(cells[j * width + i0:j * width + i1])
+                for j in range(j0, j1)))
+            self._signatures[cluster] = signature
+            return signature
+
+    def tree(self, cluster, node, moves):
+        """Dijkstra from ``node`` limited to ``cluster``.
+
+        Returns ``(dist, came_from)`` in coordinates local to the cluster.
+        """
+        i0, j0, _, _ = self.bounds(cluster)
+        local = (node[0] - i0, node[1] - j0)
+        signature = self._signature(cluster)
+        key = (signature, local, moves)
+        try:
+            return self._trees[key]
+        except KeyError:
+            pass
+
+        w, h, cells = signature
+        cells = bytearray(cells)
+        dist = {local: 0.}
+        came_from = {local: None}
+        frontier = [(0., local)]
+        while frontier:
+            cost, current = heapq.heappop(frontier)
+            if cost > dist[current]:
+                continue
+            ci, cj = current
+            for di, dj, step_cost in moves:
+                ni = ci + di
+                nj = cj + dj
+                if not (0 <= ni < w and 0 <= nj < h) or \
+                        cells[nj * w + ni] != 1:
+                    continue
+                nxt = (ni, nj)
+                new_cost = cost + step_cost
+                if nxt not in dist or new_cost < dist[nxt]:
+                    dist[nxt] = new_cost
+                    came_from[nxt] = current
+                    heapq.heappush(frontier, (new_cost, nxt))
+        tree = self._trees[key] = (dist, came_from)
+        return tree
+
+    def _local(self, cluster, node):
+        i0, j0, _, _ = self.bounds(cluster)
+        return (node[0] - i0, node[1] - j0)
+
+    def _edges(self, node, goal, moves, allowed):
+        cluster = self.cluster_of(node)
+        dist, _ = self.tree(cluster, node, moves)
+        for other in self.entrances.get(cluster, ()):
+            if other == node:
+                continue
+            cost = dist.get(self._local(cluster, other))
+            if cost is not None:
+                yield other, cost
+        if self.cluster_of(goal) == cluster:
+            cost = dist.get(self._local(cluster, goal))
+            if cost is not None:
+                yield goal, cost
+        for other in self.partners.get(node, ()):
+            delta = (other[0] - node[0], other[1] - node[1])
+            if delta in allowed:
+                yield other, allowed[delta]
+
+    def search(self, start, goal, moves):
+        """Node path from ``start`` to ``goal`` or ``None``, the abstract
+        nodes it expanded are left in ``expanded``.
+        """
+        self.ensure()
+        moves = tuple(moves)
+        allowed = {(di, dj): cost for di, dj, cost in moves}
+
+        frontier = [(octile(start, goal), start)]
+        cost_so_far = {start: 0.}
+        came_from = {start: None}
+        self.expanded = 0
+        while frontier:
+            _, current = heapq.heappop(frontier)
+            if current == goal:
+                break
+            self.expanded += 1
+            for nxt, edge_cost in self._edges(current, goal, moves, allowed):
+                new_cost = cost_so_far[current] + edge_cost
+                if nxt not in cost_so_far or new_cost < cost_so_far[nxt]:
+                    cost_so_far[nxt] = new_cost
+                    came_from[nxt] = current
+                    heapq.heappush(frontier,
+                                   (new_cost + octile(nxt, goal), nxt))
+        if goal not in came_from:
+            return None
+
+        abstract = [goal]
+        while abstract[-1] != start:
+            abstract.append(came_from[abstract[-1]])
+        abstract.reverse()
+        return self.refine(abstract, moves)
+
+    def refine(self, abstract, moves):
+        path = [abstract[0]]
+        for a, b in zip(abstract, abstract[1:]):
+            cluster = self.cluster_of(a)
+            if self.cluster_of(b) != cluster:
+                # border crossing between two partner entrances
+                path.append(b)
+                continue
+            i0, j0, _, _ = self.bounds(cluster)
+            _, came_from = self.tree(cluster, a, moves)
+            segment = []
+            current = self._local(cluster, b)
+            while came_from[current] is not None:
+                segment.append((current[0] + i0, current[1] + j0))
+                current = came_from[current]
+            path.extend(reversed(segment))
+        return path
+
+
+cluster_graph = ClusterGraph()
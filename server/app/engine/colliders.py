@@ -2,6 +2,8 @@
 """
 from __future__ import division
 
+import heapq
+import itertools
 import logging
 from contextlib import contextmanager
 
@@ -19,6 +21,8 @@ class SpatialHash(object):
     def __init__(self, cell_size=settings.GAME['CELL_SIZE']):
         self.cell_size = float(cell_size)
         self.contents = {}
+        # bumped on every change, lets derived data know it is stale
+        self.version = 0
         # self.make_map()
 
     def _hash(self, point):
@@ -31,20 +35,22 @@ class SpatialHash(object):
         return (int(px / self.cell_size),
                 int(py / self.cell_size))
 
+    def clear(self):
+        self.contents = {}
+        self.version += 1
+
     def insert_object_for_point(self, point, obj):
         self.contents.setdefault(self._hash(point), set()).add(obj)
+        self.version += 1
 
     def insert_object_for_box(self, box, obj):
         for cell in self._get_cells(box):
             # append to each intersecting cell
             self.contents.setdefault(cell, set()).add(obj)
+        self.version += 1
 
     def _get_cells(self, box):
         # hash the minimum and maximum points
-        box['min'] = (box['min'] if isinstance(box['min'], (list, tuple))
-                      else (box['min']['x'], box['min']['y']))
-        box['max'] = (box['max'] if isinstance(box['max'], (list, tuple))
-                      else (box['max']['x'], box['max']['y']))
         min, max = self._hash(box['min']), self._hash(box['max'])
         return ((i, j) for j in range(min[1], max[1] + 1)
                 for i in range(min[0], max[0] + 1))
@@ -55,6 +61,7 @@ class SpatialHash(object):
             cell.remove(obj)
         except KeyError:
             pass
+        self.version += 1
 
     def remove_obj_by_box(self, box, obj):
         for cell in self._get_cells(box):
@@ -63,6 +70,7 @@ class SpatialHash(object):
                 cell.remove(obj)
             except KeyError:
                 pass
+        self.version += 1
 
     def pottential_collisions(self, box, obj, single=False):
         potensial_collisions = set()
@@ -78,11 +86,7 @@ class SpatialHash(object):
             except KeyError:
                 pass
 
-        try:
-            potensial_collisions.remove(obj)
-        except KeyError:
-            pass
-        logging.debug(potensial_collisions)
+        potensial_collisions.discard(obj)
         return potensial_collisions
 
     @staticmethod
@@ -95,7 +99,327 @@ class SpatialHash(object):
         return True if cells else False
 
 
-spatial_hash = SpatialHash()
+def _bounds(shape):
+    """``(x0, y0, x1, y1)`` of a point or a ``{'min': .., 'max': ..}`` box,
+    points may be tuples or ``{'x': .., 'y': ..}`` dicts.
+    """
+    if isinstance(shape, dict) and 'min' in shape:
+        x0, y0 = _point(shape['min'])
+        x1, y1 = _point(shape['max'])
+        return x0, y0, x1, y1
+    x, y = _point(shape)
+    return x, y, x, y
+
+
+def _point(point):
+    if isinstance(point, dict):
+        return point['x'], point['y']
+    return point[0], point[1]
+
+
+class UniformGrid(object):
+    """Dense grid of ``cell_size`` px cells over the map.
+
+    Entities get an integer id when inserted. Every cell is a set of the
+    ids overlapping it, in a flat list indexed by ``j * cols + i``, and
+    the cells an entity covers are kept with it, so ``move`` only touches
+    the cells it left and entered. The parts of the entities beyond the
+    map are not indexed. The grid is sized from ``local_db['map_size']``
+    and ``ensure`` sizes it again when that changes.
+
+    The ``SpatialHash`` methods work on top of it, with the objects
+    instead of their ids.
+    """
+
+    def __init__(self, cell_size=settings.GAME['CELL_SIZE']):
+        self.cell_size = float(cell_size)
+        # bumped whenever cells change, lets derived data know it is stale
+        self.version = 0
+        self.objects = {}
+        self.bounds = {}
+        self.spans = {}
+        self._ids = {}
+        self._next_id = itertools.count(1)
+        self.width = self.height = None
+        self.ensure()
+
+    def ensure(self):
+        map_size = local_db['map_size']
+        if (map_size['width'], map_size['height']) != (self.width,
+                                                       self.height):
+            self.resize(map_size['width'], map_size['height'])
+        return self
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.cols = max(1, -(-int(width) // int(self.cell_size)))
+        self.rows = max(1, -(-int(height) // int(self.cell_size)))
+        self.cells = [set() for _ in range(self.cols * self.rows)]
+        for eid, bounds in self.bounds.items():
+            self.spans[eid] = span = self._span(bounds)
+            for index in self._indexes(span):
+                self.cells[index].add(eid)
+        self.version += 1
+
+    def _span(self, bounds):
+        """Cells ``(i0, j0, i1, j1)`` overlapped by ``bounds``, inclusive,
+        ``None`` when all of them are beyond the map.
+        """
+        x0, y0, x1, y1 = bounds
+        size = self.cell_size
+        i0 = max(0, int(x0 // size))
+        j0 = max(0, int(y0 // size))
+        i1 = min(self.cols - 1, int(x1 // size))
+        j1 = min(self.rows - 1, int(y1 // size))
+        if i0 > i1 or j0 > j1:
+            return None
+        return i0, j0, i1, j1
+
+    def _indexes(self, span):
+        if span is None:
+            return ()
+        i0, j0, i1, j1 = span
+        cols = self.cols
+        return [j * cols + i for j in range(j0, j1 + 1)
+                for i in range(i0, i1 + 1)]
+
+    def id_of(self, obj):
+        return self._ids.get(obj)
+
+    def insert(self, obj, shape):
+        """Index ``obj`` at a point or a box, returns its id"""
+        eid = next(self._next_id)
+        self.objects[eid] = obj
+        self._ids[obj] = eid
+        self.bounds[eid] = bounds = _bounds(shape)
+        self.spans[eid] = span = self._span(bounds)
+        for index in self._indexes(span):
+            self.cells[index].add(eid)
+        self.version += 1
+        return eid
+
+    def move(self, eid, shape):
+        self.bounds[eid] = bounds = _bounds(shape)
+        span = self._span(bounds)
+        old = self.spans[eid]
+        if span == old:
+            return eid
+        self.spans[eid] = span
+        cells = self.cells
+        for index in self._indexes(old):
+            cells[index].discard(eid)
+        for index in self._indexes(span):
+            cells[index].add(eid)
+        self.version += 1
+        return eid
+
+    def update(self, obj, shape):
+        """Move ``obj`` or insert it when it is not indexed yet"""
+        eid = self._ids.get(obj)
+        if eid is None:
+            return self.insert(obj, shape)
+        return self.move(eid, shape)
+
+    def remove(self, eid):
+        obj = self.objects.pop(eid, None)
+        if obj is None:
+            return
+        self._ids.pop(obj, None)
+        del self.bounds[eid]
+        for index in self._indexes(self.spans.pop(eid)):
+            self.cells[index].discard(eid)
+        self.version += 1
+
+    def clear(self):
+        self.objects = {}
+        self.bounds = {}
+        self.spans = {}
+        self._ids = {}
+        self.cells = [set() for _ in range(self.cols * self.rows)]
+        self.version += 1
+
+    def query(self, shape, exclude=None):
+        """Ids of the entities in the cells overlapped by ``shape``"""
+        found = set()
+        cells = self.cells
+        for index in self._indexes(self._span(_bounds(shape))):
+            found |= cells[index]
+        found.discard(exclude)
+        return found
+
+    def batch_query(self, shapes):
+        """``query`` of every shape in one pass, the cells overlapped by
+        several of them are merged once.
+        """
+        merged = {}
+        results = []
+        for shape in shapes:
+            span = self._span(_bounds(shape))
+            try:
+                found = merged[span]
+            except KeyError:
+                found = merged[span] = set()
+                for index in self._indexes(span):
+                    found |= self.cells[index]
+            results.append(found)
+        return results
+
+    def _distance_sq(self, eid, x, y):
+        x0, y0, x1, y1 = self.bounds[eid]
+        dx = max(x0 - x, 0, x - x1)
+        dy = max(y0 - y, 0, y - y1)
+        return dx * dx + dy * dy
+
+    def _cell_distance_sq(self, index, x, y):
+        size = self.cell_size
+        i, j = index % self.cols, index // self.cols
+        dx = max(i * size - x, 0, x - (i + 1) * size)
+        dy = max(j * size - y, 0, y - (j + 1) * size)
+        return dx * dx + dy * dy
+
+    def query_radius(self, point, r, exclude=None):
+        """``[(obj, distance ** 2)]`` of the entities within ``r`` px of
+        ``point``, only the cells the circle overlaps are visited.
+        """
+        x, y = _point(point)
+        r_sq = r * r
+        exclude = self._ids.get(exclude)
+        found = {}
+        for index in self._indexes(self._span((x - r, y - r, x + r, y + r))):
+            ids = self.cells[index]
+            if not ids or self._cell_distance_sq(index, x, y) > r_sq:
+                continue
+            for eid in ids:
+                if eid in found or eid == exclude:
+                    continue
+                distance_sq = self._distance_sq(eid, x, y)
+                if distance_sq <= r_sq:
+                    found[eid] = distance_sq
+        return [(self.objects[eid], distance_sq)
+                for eid, distance_sq in found.items()]
+
+    def nearest(self, point, k=1, predicate=None, max_distance=None):
+        """``[(obj, distance ** 2)]`` of the ``k`` entities closest to
+        ``point`` passing ``predicate``, the closest first.
+
+        Cells are visited in rings around the one of ``point`` until the
+        next ring can't hold anything closer.
+        """
+        x, y = _point(point)
+        size = self.cell_size
+        limit_sq = max_distance ** 2 if max_distance is not None else None
+        # the point may be off the map, the rings go around the closest cell
+        ci = min(max(int(x // size), 0), self.cols - 1)
+        cj = min(max(int(y // size), 0), self.rows - 1)
+        best = []
+        seen = set()
+        for ring in range(max(self.cols, self.rows)):
+            # nothing in this ring or further is closer
+            reach = max(0, ring - 1) * size
+            if limit_sq is not None and reach * reach > limit_sq:
+                break
+            if len(best) == k and reach * reach > -best[0][0]:
+                break
+            for index in self._ring(ci, cj, ring):
+                for eid in self.cells[index]:
+                    if eid in seen:
+                        continue
+                    seen.add(eid)
+                    distance_sq = self._distance_sq(eid, x, y)
+                    if limit_sq is not None and distance_sq > limit_sq:
+                        continue
+                    if len(best) == k and distance_sq >= -best[0][0]:
+                        continue
+                    obj = self.objects[eid]
+                    if predicate is not None and not predicate(obj):
+                        continue
+                    # max heap of the k closest by negated distance
+                    heapq.heappush(best, (-distance_sq, eid))
+                    if len(best) > k:
+                        heapq.heappop(best)
+        return [(self.objects[eid], -distance_sq)
+                for distance_sq, eid in sorted(best, reverse=True)]
+
+    def _ring(self, ci, cj, ring):
+        """Indexes of the cells ``ring`` cells away from ``(ci, cj)``"""
+        cols, rows = self.cols, self.rows
+        if not ring:
+            return [cj * cols + ci]
+        indexes = []
+        for i in range(ci - ring, ci + ring + 1):
+            if 0 <= i < cols:
+                if cj - ring >= 0:
+                    indexes.append((cj - ring) * cols + i)
+                if cj + ring < rows:
+                    indexes.append((cj + ring) * cols + i)
+        for j in range(cj - ring + 1, cj + ring):
+            if 0 <= j < rows:
+                if ci - ring >= 0:
+                    indexes.append(j * cols + ci - ring)
+                if ci + ring < cols:
+                    indexes.append(j * cols + ci + ring)
+        return indexes
+
+    def occupied(self):
+        """``((i, j), objects)`` of the cells holding anything"""
+        cols, objects = self.cols, self.objects
+        for index, ids in enumerate(self.cells):
+            if ids:
+                yield ((index % cols, index // cols),
+                       set(objects[eid] for eid in ids))
+
+    # ``SpatialHash`` interface
+
+    @property
+    def contents(self):
+        return dict(self.occupied())
+
+    def _hash(self, point):
+        x, y = _point(point)
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def insert_object_for_point(self, point, obj):
+        self.update(obj, point)
+
+    def insert_object_for_box(self, box, obj):
+        self.update(obj, box)
+
+    def remove_obj_by_point(self, point, obj):
+        self.remove(self._ids.get(obj))
+
+    def remove_obj_by_box(self, box, obj):
+        self.remove(self._ids.get(obj))
+
+    def pottential_collisions(self, box, obj, single=False):
+        objects = self.objects
+        return set(objects[eid]
+                   for eid in self.query(box, exclude=self._ids.get(obj)))
+
+    def in_bounds(self, point):
+        return bool(0 <= point[0] < self.width and
+                    0 <= point[1] < self.height)
+
+    def is_predict_point_collide(self, point):
+        return bool(self.query(point))
+
+
+# static collisions of the map
+spatial_hash = UniformGrid()
+# moving bodies, brought up to date on every simulation tick
+bodies_hash = UniformGrid()
+
+
+def index_bodies(bodies, grid=bodies_hash):
+    """Move the bodies in ``grid`` to their coords and drop the ones that
+    are gone.
+    """
+    current = set()
+    for body in bodies:
+        current.add(grid.update(body, body.coords))
+    for eid in list(grid.objects):
+        if eid not in current:
+            grid.remove(eid)
 
 
 @contextmanager
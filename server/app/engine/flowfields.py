@@ -0,0 +1,154 @@
+"""Flow fields, one search per goal shared by all the walkers
+"""
+from __future__ import division
+
+import heapq
+import time
+
+from conf import settings
+
+from .grids import passability
+from .metrics import metrics
+
+
+NO_MOVE = 255
+
+
+class FlowField(object):
+    """Integration field of a ``PassabilityGrid`` towards ``goal`` node.
+
+    A Dijkstra from the goal, run by ``expand`` as far as it is needed.
+    Nodes come out of it closest first, so once a node is settled the
+    whole way from it to the goal is, and ``towards`` holds the index of
+    the move to take from every settled node.
+    """
+
+    def __init__(self, grid, goal, moves):
+        self.grid = grid
+        self.goal = goal
+        self.moves = moves
+        size = grid.width * grid.height
+        self.dist = [float('inf')] * size
+        self.towards = bytearray([NO_MOVE]) * size
+        self.settled = bytearray(size)
+        self.frontier = []
+        self.last_used = time.time()
+        index = goal[1] * grid.width + goal[0]
+        if grid.cells[index] == 1:
+            self.dist[index] = 0.
+            self.frontier.append((0., index))
+
+    @property
+    def done(self):
+        return not self.frontier
+
+    def index(self, node):
+        return node[1] * self.grid.width + node[0]
+
+    def is_settled(self, node):
+        return self.settled[self.index(node)] == 1
+
+    def expand(self, limit=None, until=None):
+        """Settle at most ``limit`` nodes, stops early once node ``until``
+        is settled. Returns the number of the settled nodes.
+        """
+        grid = self.grid
+        cells, width, height = grid.cells, grid.width, grid.height
+        dist, towards, settled = self.dist, self.towards, self.settled
+        frontier = self.frontier
+        stop = self.index(until) if until is not None else None
+        # the walker takes move ``k`` from the neighbour to ``current``
+        neighbours = [(k, -di, -dj, -(dj * width + di), step_cost)
+                      for k, (di, dj, step_cost) in enumerate(self.moves)]
+        expanded = 0
+        while frontier:
+            if stop is not None and settled[stop]:
+                break
+            if limit is not None and expanded >= limit:
+                break
+            cost, current = heapq.heappop(frontier)
+            if settled[current]:
+                continue
+            settled[current] = 1
+            expanded += 1
+            ci = current % width
+            cj = current // width
+            for k, di, dj, offset, step_cost in neighbours:
+                if not (0 <= ci + di < width and 0 <= cj + dj < height):
+                    continue
+                nxt = current + offset
+                new_cost = cost + step_cost
+                if cells[nxt] == 1 and new_cost < dist[nxt]:
+                    dist[nxt] = new_cost
+                    towards[nxt] = k
+                    heapq.heappush(frontier, (new_cost, nxt))
+        return expanded
+
+    def next_node(self, node):
+        """Node to step on from the settled ``node``, ``None`` at the goal
+        or when the goal can't be reached from it.
+        """
+        k = self.towards[self.index(node)]
+        if k == NO_MOVE:
+            return None
+        di, dj, _ = self.moves[k]
+        return (node[0] + di, node[1] + dj)
+
+    def path(self, node):
+        """Nodes from ``node`` to the goal, empty when there is no way"""
+        self.last_used = time.time()
+        if node != self.goal and self.next_node(node) is None:
+            return []
+        path = [node]
+        while path[-1] != self.goal:
+            path.append(self.next_node(path[-1]))
+        return path
+
+
+class FlowFields(object):
+    """Flow fields of a grid cached per goal node and allowed moves.
+
+    All of them are dropped when the grid changes, the ones no walker has
+    read for ``ttl`` seconds go away on ``update``, and there are never
+    more than ``size`` of them.
+    """
+
+    def __init__(self, grid=passability,
+                 size=settings.PATHFINDING['FLOW_FIELDS'],
+                 ttl=settings.PATHFINDING['FLOW_FIELD_TTL']):
+        self.grid = grid
+        self.size = size
+        self.ttl = ttl
+        self.fields = {}
+        self._key = None
+
+    def get(self, goal, moves):
+        self.grid.ensure()
+        if self.grid.version != self._key:
+            self.fields = {}
+            self._key = self.grid.version
+        key = (goal, tuple(moves))
+        try:
+            field = self.fields[key]
+        except KeyError:
+            if len(self.fields) >= self.size:
+                self._evict(min(self.fields,
+                                key=lambda k: self.fields[k].last_used))
+            field = self.fields[key] = FlowField(self.grid, goal, key[1])
+            metrics.incr('pathfinding.flow.fields')
+        field.last_used = time.time()
+        return field
+
+    def update(self, dt=None):
+        deadline = time.time() - self.ttl
+        for key, field in list(self.fields.items()):
+            if field.last_used < deadline:
+                self._evict(key)
+        metrics.gauge('pathfinding.flow.cached', len(self.fields))
+
+    def _evict(self, key):
+        del self.fields[key]
+        metrics.incr('pathfinding.flow.evicted')
+
+
+flow_fields = FlowFields()
@@ -0,0 +1,182 @@
+"""Precomputed passability of the map
+"""
+from __future__ import division
+
+from conf import settings
+from db import local_db
+
+from .colliders import spatial_hash
+
+
+def traverse(a, b, step):
+    """Nodes of ``step`` px the segment from point ``a`` to ``b`` passes
+    through, in order.
+    """
+    x0, y0 = a[0] / step, a[1] / step
+    x1, y1 = b[0] / step, b[1] / step
+    i, j = int(x0), int(y0)
+    end = (int(x1), int(y1))
+    di = (x1 > x0) - (x1 < x0)
+    dj = (y1 > y0) - (y1 < y0)
+    dx = abs(x1 - x0)
+    dy = abs(y1 - y0)
+    # the segment parameter at the next border crossing on each axis
+    inf = float('inf')
+    next_x = ((i + 1 - x0) if di > 0 else (x0 - i)) / dx if dx else inf
+    next_y = ((j + 1 - y0) if dj > 0 else (y0 - j)) / dy if dy else inf
+    step_x = 1 / dx if dx else inf
+    step_y = 1 / dy if dy else inf
+
+    for _ in range(abs(end[0] - i) + abs(end[1] - j) + 1):
+        yield (i, j)
+        if (i, j) == end:
+            return
+        # right through a corner both change, diagonal steps may cut it
+        # too. A point on a border belongs to the node after it, so going
+        # left or up the last crossing may be the end itself, never past it
+        move_i = i != end[0] and next_x <= next_y
+        move_j = j != end[1] and next_y <= next_x
+        if not (move_i or move_j):
+            move_i = i != end[0]
+            move_j = not move_i
+        if move_i:
+            i += di
+            next_x += step_x
+        if move_j:
+            j += dj
+            next_y += step_y
+
+
+class PassabilityGrid(object):
+    """One byte per footpace node of the map, 1 - passable, 0 - blocked.
+
+    Node ``(i, j)`` stands for the point ``(i * step, j * step)`` and
+    covers ``step`` px around it. Built from the occupied cells of the
+    static collisions ``UniformGrid`` on top of the cells of the
+    ``CompiledMap`` in use, if any, and built again only when one of them
+    or the map size changes. Collider cells holding only objects of that
+    map are left alone, the map cells have their exact shapes.
+    """
+
+    def __init__(self, step=settings.GAME['FOOTPACE'], collider=spatial_hash):
+        self.step = step
+        self.collider = collider
+        self.width = 0
+        self.height = 0
+        self.map_width = 0
+        self.map_height = 0
+        self.cells = bytearray()
+        self.compiled = None
+        self._key = None
+
+    def use_map(self, compiled):
+        """Start from the precomputed cells of ``compiled``"""
+        self.compiled = compiled
+
+    def ensure(self):
+        map_size = local_db['map_size']
+        key = (self.collider.version, map_size['width'], map_size['height'],
+               getattr(self.compiled, 'digest', None))
+        if key != self._key:
+            self.build(map_size['width'], map_size['height'])
+            self._key = key
+        return self
+
+    @property
+    def version(self):
+        """Changes whenever the grid is built again"""
+        return self._key
+
+    def build(self, map_width, map_height):
+        step = self.step
+        self.map_width = map_width
+        self.map_height = map_height
+        self.width = width = -(-int(map_width) // step)
+        self.height = height = -(-int(map_height) // step)
+        compiled = self.compiled
+        if (compiled is not None and compiled.step == step and
+                (compiled.width, compiled.height) == (width, height)):
+            cells = bytearray(compiled.cells)
+            exact = set(compiled.objects)
+        else:
+            cells = bytearray(b'\x01') * (width * height)
+            exact = set()
+
+        cell_size = self.collider.cell_size
+        for (cx, cy), objects in self.collider.occupied():
+            if objects <= exact:
+                continue
+            i0, i1 = self._span(cx, cell_size, width)
+            j0, j1 = self._span(cy, cell_size, height)
+            if i0 >= i1:
+                continue
+            blocked = bytearray(i1 - i0)
+            for j in range(j0, j1):
+                row = j * width
+                cells[row + i0:row + i1] = blocked
+        self.cells = cells
+
+    def _span(self, c, cell_size, limit):
+        """Node indexes whose points fall into the hash cell ``c``"""
+        lo = max(0, -(-int(c * cell_size) // self.step))
+        hi = min(limit, -(-int((c + 1) * cell_size) // self.step))
+        return lo, hi
+
+    def freeze(self):
+        """Picklable copy of the grid, see ``FrozenGrid``"""
+        return (self._key, self.step, self.map_width, self.map_height,
+                bytes(self.cells))
+
+    def index(self, point):
+        x, y = point
+        if not (0 <= x < self.map_width and 0 <= y < self.map_height):
+            return -1
+        return int(y) // self.step * self.width + int(x) // self.step
+
+    def in_bounds(self, point):
+        return self.index(point) >= 0
+
+    def passable(self, point):
+        idx = self.index(point)
+        return idx >= 0 and self.cells[idx] == 1
+
+    def _open(self, i, j):
+        return (0 <= i < self.width and 0 <= j < self.height and
+                self.cells[j * self.width + i] == 1)
+
+    def traverse(self, a, b):
+        """Nodes the segment from point ``a`` to ``b`` passes through, in
+        order, out of the grid ones included.
+        """
+        return traverse(a, b, self.step)
+
+    def line_of_sight(self, a, b, blocked=()):
+        """Whether all the nodes the segment from point ``a`` to ``b``
+        passes through are passable and not in ``blocked``.
+        """
+        node = None
+        for node in self.traverse(a, b):
+            if not self._open(*node) or node in blocked:
+                return False
+        return node == (int(b[0] / self.step), int(b[1] / self.step))
+
+
+class FrozenGrid(PassabilityGrid):
+    """Grid made of a ``PassabilityGrid.freeze`` copy, e.g. in another
+    process, it never builds itself from the collisions.
+    """
+
+    def __init__(self, key, step, map_width, map_height, cells):
+        super(FrozenGrid, self).__init__(step, collider=None)
+        self.map_width = map_width
+        self.map_height = map_height
+        self.width = -(-int(map_width) // step)
+        self.height = -(-int(map_height) // step)
+        self.cells = bytearray(cells)
+        self._key = key
+
+    def ensure(self):
+        return self
+
+
+passability = PassabilityGrid()
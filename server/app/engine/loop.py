@@ -0,0 +1,145 @@
+"""Fixed timestep game loop
+"""
+from __future__ import division
+
+import time
+import logging
+from collections import OrderedDict
+
+import gevent
+
+from conf import settings
+
+from .metrics import metrics
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class Phase(object):
+    """Group of systems run at a fixed rate, every system gets the fixed
+    ``dt`` of the phase.
+
+    When the phase falls behind, ``catch_up`` runs the missed ticks back to
+    back (at most ``max_catch_up`` at once), ``skip`` runs a single tick and
+    drops the rest.
+    """
+
+    CATCH_UP = 'catch_up'
+    SKIP = 'skip'
+
+    def __init__(self, name, rate, policy=SKIP,
+                 max_catch_up=settings.GAME['MAX_CATCH_UP']):
+        if policy not in (self.CATCH_UP, self.SKIP):
+            raise ValueError('Unknown tick policy %s.' % policy)
+        self.name = name
+        self.rate = rate
+        self.period = 1 / rate
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.systems = []
+        self.next_at = None
+        self.worst = 0.
+
+    def add_system(self, system):
+        self.systems.append(system)
+
+    def tick(self):
+        started = clock()
+        for system in self.systems:
+            try:
+                system(self.period)
+            except Exception:
+                logging.exception('Phase %s: system %s failed',
+                                  self.name, system)
+        spent = clock() - started
+        metrics.incr('loop.%s.ticks' % self.name)
+        if spent > self.period:
+            metrics.incr('loop.%s.overruns' % self.name)
+        self.worst = max(self.worst, spent)
+        return spent
+
+    def run_due(self, now):
+        if self.next_at is None:
+            self.next_at = now
+        runs = 0
+        while now >= self.next_at:
+            if runs and (self.policy == self.SKIP or
+                         runs >= self.max_catch_up):
+                behind = int((now - self.next_at) // self.period) + 1
+                metrics.incr('loop.%s.skipped' % self.name, behind)
+                self.next_at += behind * self.period
+                break
+            self.tick()
+            runs += 1
+            # schedule from the ideal time, not from now, so the work done
+            # in a tick doesn't drift the period
+            self.next_at += self.period
+            now = clock()
+        return now
+
+
+class GameLoop(object):
+    """Cooperative scheduler for the game phases, e.g. simulation at
+    ``GAME['FPS']`` and broadcast at ``NETWORK['BROADCAST_RATE']``.
+    """
+
+    def __init__(self, report_every=settings.GAME['TICK_REPORT']):
+        self.phases = OrderedDict()
+        self.report_every = report_every
+        self.running = False
+        self._reported_at = None
+        self._reported = {}
+
+    def add_phase(self, name, rate, policy=Phase.SKIP):
+        phase = self.phases[name] = Phase(name, rate, policy)
+        return phase
+
+    def add_system(self, phase, system):
+        self.phases[phase].add_system(system)
+
+    def step(self):
+        """Run due phases, return seconds to sleep until the next one"""
+        now = clock()
+        for phase in self.phases.values():
+            now = phase.run_due(now)
+        self.report(now)
+        if not self.phases:
+            return 0.
+        next_at = min(phase.next_at for phase in self.phases.values())
+        return max(0., next_at - clock())
+
+    def report(self, now):
+        if self._reported_at is None:
+            self._reported_at = now
+        if now - self._reported_at < self.report_every:
+            return
+        self._reported_at = now
+        for phase in self.phases.values():
+            overruns = metrics.get('loop.%s.overruns' % phase.name)
+            skipped = metrics.get('loop.%s.skipped' % phase.name)
+            new_overruns = overruns - self._reported.get(
+                (phase.name, 'overruns'), 0)
+            new_skipped = skipped - self._reported.get(
+                (phase.name, 'skipped'), 0)
+            if new_overruns or new_skipped:
+                logging.warning(
+                    'Phase %s is over budget: %s overruns, %s skipped ticks, '
+                    'worst tick %.1f ms of %.1f ms', phase.name,
+                    new_overruns, new_skipped, phase.worst * 1000,
+                    phase.period * 1000)
+            self._reported[phase.name, 'overruns'] = overruns
+            self._reported[phase.name, 'skipped'] = skipped
+            metrics.gauge('loop.%s.worst' % phase.name, phase.worst)
+            phase.worst = 0.
+
+    def run(self):
+        self.running = True
+        while self.running:
+            gevent.sleep(self.step())
+
+    def stop(self):
+        self.running = False
+
+
+game_loop = GameLoop()
@@ -0,0 +1,276 @@
+"""Compiled maps, the collisions of a TMX map precomputed into a binary
+artifact loaded at startup instead of parsing the map
+"""
+from __future__ import division
+
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+from xml.etree import ElementTree
+
+from conf import settings
+
+from .grids import traverse
+
+
+MAGIC = b'BXMP'
+# bumped whenever the layout or the way the grid is made changes
+FORMAT = 3
+# sides of the polygons turned ellipses are taken as
+ELLIPSE_SIDES = 32
+# magic, format, sha1 of the source, step, map width and height in px,
+# nodes across and down, boxes, spawn points
+HEADER = struct.Struct('<4sH20sHIIIIII')
+
+
+def artifact_path(source):
+    return os.path.splitext(source)[0] + '.map'
+
+
+def source_hash(source):
+    with open(source, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+class MapObject(object):
+    """Collision object of a compiled map, known by the box it fits in"""
+
+    __slots__ = ('x', 'y', 'width', 'height')
+
+    def __init__(self, box):
+        x0, y0, x1, y1 = box
+        self.x, self.y = x0, y0
+        self.width, self.height = x1 - x0, y1 - y0
+
+    @property
+    def box(self):
+        return {'min': (self.x, self.y),
+                'max': (self.x + self.width, self.y + self.height)}
+
+
+class CompiledMap(object):
+    """Map read from an artifact of ``compile_map``.
+
+    The file is memory mapped, ``cells`` are a view of it, one byte per
+    ``step`` px node like in ``PassabilityGrid``, with the exact shapes
+    of the collision objects. ``boxes`` are the ``(x0, y0, x1, y1)`` the
+    objects fit in, ``objects`` the ``MapObject`` of each of them, and
+    ``spawns`` are the ``(x, y)`` where characters come into the map.
+    """
+
+    def __init__(self, data, path=None):
+        (magic, fmt, self.digest, self.step, self.map_width, self.map_height,
+         self.width, self.height, boxes, spawns) = HEADER.unpack_from(data)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError('%s is not a compiled map of format %s.' %
+                             (path, FORMAT))
+        self.path = path
+        offset = HEADER.size
+        size = self.width * self.height
+        self.cells = memoryview(data)[offset:offset + size]
+        offset += size
+        coords = struct.unpack_from('<%df' % (boxes * 4 + spawns * 2),
+                                    data, offset)
+        self.boxes = [coords[n:n + 4] for n in range(0, boxes * 4, 4)]
+        self.objects = [MapObject(box) for box in self.boxes]
+        self.spawns = [coords[n:n + 2]
+                       for n in range(boxes * 4, len(coords), 2)]
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data, path)
+
+
+def rasterize(shapes, step, map_width, map_height):
+    """Passability cells of the map with the nodes covered by ``shapes``
+    blocked.
+
+    Shapes are ``(kind, data)``: ``'box'`` and ``'ellipse'`` with the
+    ``(x0, y0, x1, y1)`` they fit in, ``'polygon'`` and ``'polyline'``
+    with their points. Nodes whose point is inside a box, an ellipse or a
+    polygon are blocked, as well as the ones the lines of polygons and
+    polylines pass through, so thin walls never leak. Flat ellipses are
+    taken as lines.
+    """
+    width = -(-int(map_width) // step)
+    height = -(-int(map_height) // step)
+    cells = bytearray(b'\x01') * (width * height)
+
+    def fill(j, x0, x1):
+        """Block the nodes of row ``j`` with the point in ``[x0, x1)``"""
+        if not 0 <= j < height:
+            return
+        i0 = max(0, int(-(-x0 // step)))
+        i1 = min(width, int(-(-x1 // step)))
+        if i0 < i1:
+            cells[j * width + i0:j * width + i1] = bytearray(i1 - i0)
+
+    def rows(y0, y1):
+        return range(max(0, int(-(-y0 // step))),
+                     min(height, int(-(-y1 // step))))
+
+    def trace(points):
+        for a, b in zip(points, points[1:]):
+            for i, j in traverse(a, b, step):
+                if 0 <= i < width and 0 <= j < height:
+                    cells[j * width + i] = 0
+
+    for kind, data in shapes:
+        if kind == 'box':
+            x0, y0, x1, y1 = data
+            for j in rows(y0, y1):
+                fill(j, x0, x1)
+        elif kind == 'ellipse':
+            x0, y0, x1, y1 = data
+            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+            rx, ry = (x1 - x0) / 2, (y1 - y0) / 2
+            if not rx or not ry:
+                trace([(x0, y0), (x1, y1)])
+                continue
+            for j in rows(y0, y1):
+                dy = (j * step - cy) / ry
+                half = rx * math.sqrt(max(0., 1 - dy * dy))
+                fill(j, cx - half, cx + half)
+        elif kind == 'polygon':
+            edges = list(zip(data, data[1:] + data[:1]))
+            for j in rows(min(y for _, y in data), max(y for _, y in data)):
+                # scanline, the row enters and leaves the polygon by turns
+                y = j * step
+                xs = sorted(ax + (y - ay) * (bx - ax) / (by - ay)
+                            for (ax, ay), (bx, by) in edges
+                            if (ay <= y < by) or (by <= y < ay))
+                for x0, x1 in zip(xs[::2], xs[1::2]):
+                    fill(j, x0, x1)
+            trace(data + data[:1])
+        elif kind == 'polyline':
+            trace(data)
+    return width, height, cells
+
+
+def _rotate(points, origin, degrees):
+    """Tiled turns objects clockwise around their ``(x, y)``"""
+    if not degrees:
+        return points
+    angle = math.radians(degrees)
+    cos, sin = math.cos(angle), math.sin(angle)
+    ox, oy = origin
+    return [(ox + (x - ox) * cos - (y - oy) * sin,
+             oy + (x - ox) * sin + (y - oy) * cos) for x, y in points]
+
+
+def _ellipse_polygon(box, origin, degrees):
+    """Points of a polygon around the ellipse fitting in ``box``, turned
+    like ``_rotate``. Its sides touch the ellipse, so it covers it all.
+    """
+    x0, y0, x1, y1 = box
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    grow = 1 / math.cos(math.pi / ELLIPSE_SIDES)
+    rx, ry = (x1 - x0) / 2 * grow, (y1 - y0) / 2 * grow
+    points = [(cx + rx * math.cos(angle), cy + ry * math.sin(angle))
+              for angle in (2 * math.pi * (n + .5) / ELLIPSE_SIDES
+                            for n in range(ELLIPSE_SIDES))]
+    return _rotate(points, origin, degrees)
+
+
+def _bounds(points):
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _shape(obj, ellipses):
+    """``(kind, data)`` of a TMX object, see ``rasterize``"""
+    origin = (obj.x, obj.y)
+    rotation = getattr(obj, 'rotation', 0)
+    points = getattr(obj, 'points', None)
+    if points:
+        points = _rotate([tuple(p) for p in points], origin, rotation)
+        return ('polygon' if getattr(obj, 'closed', True) else 'polyline',
+                points)
+    box = (obj.x, obj.y, obj.x + obj.width, obj.y + obj.height)
+    if obj.id in ellipses:
+        if rotation:
+            return ('polygon', _ellipse_polygon(box, origin, rotation))
+        return ('ellipse', box)
+    if rotation:
+        return ('polygon', _rotate([box[:2], (box[2], box[1]), box[2:],
+                                    (box[0], box[3])], origin, rotation))
+    return ('box', box)
+
+
+def _ellipses(source):
+    """Ids of the ellipse objects, pytmx reads them as boxes"""
+    return set(int(node.get('id'))
+               for node in ElementTree.parse(source).iter('object')
+               if node.find('ellipse') is not None)
+
+
+def _read_tmx(source):
+    """``(map_width, map_height, shapes, spawns)`` of a TMX map. Objects
+    of the ``spawn`` type are spawn points, all the others collide.
+    """
+    # only needed when the artifact is stale
+    import pytmx
+
+    tiled_map = pytmx.TiledMap(source)
+    ellipses = _ellipses(source)
+    shapes = []
+    spawns = []
+    for layer in tiled_map.layers:
+        if not isinstance(layer, pytmx.TiledObjectGroup):
+            continue
+        for obj in layer:
+            if getattr(obj, 'type', None) == 'spawn':
+                spawns.append((obj.x + obj.width / 2,
+                               obj.y + obj.height / 2))
+            else:
+                shapes.append(_shape(obj, ellipses))
+    return (tiled_map.width * tiled_map.tilewidth,
+            tiled_map.height * tiled_map.tileheight, shapes, spawns)
+
+
+def compile_map(source, target=None, step=settings.GAME['FOOTPACE']):
+    """Write the artifact of TMX map ``source``, returns its path"""
+    target = target or artifact_path(source)
+    map_width, map_height, shapes, spawns = _read_tmx(source)
+    width, height, cells = rasterize(shapes, step, map_width, map_height)
+    boxes = [data if kind in ('box', 'ellipse') else _bounds(data)
+             for kind, data in shapes]
+    coords = [c for box in boxes for c in box] + \
+        [c for spawn in spawns for c in spawn]
+    header = HEADER.pack(MAGIC, FORMAT, source_hash(source), step,
+                         int(map_width), int(map_height), width, height,
+                         len(boxes), len(spawns))
+    # never leave a half written artifact for the next start
+    partial = '%s.%s' % (target, os.getpid())
+    with open(partial, 'wb') as f:
+        f.write(header)
+        f.write(bytes(cells))
+        f.write(struct.pack('<%df' % len(coords), *coords))
+    os.rename(partial, target)
+    return target
+
+
+def load_map(source, target=None, step=settings.GAME['FOOTPACE']):
+    """``CompiledMap`` of TMX map ``source``, compiled again only when
+    the map or the step changed since the artifact was written.
+    """
+    target = target or artifact_path(source)
+    if not os.path.exists(source):
+        # shipped without the source
+        return CompiledMap.open(target)
+    digest = source_hash(source)
+    try:
+        compiled = CompiledMap.open(target)
+    except (IOError, OSError, ValueError, struct.error):
+        compiled = None
+    if (compiled is not None and compiled.digest == digest and
+            compiled.step == step):
+        return compiled
+    logging.info('Compiling map %s to %s', source, target)
+    return CompiledMap.open(compile_map(source, target, step))
@@ -0,0 +1,29 @@
+"""Process wide counters and gauges
+"""
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def get(self, name, default=0):
+        try:
+            return self.counters[name]
+        except KeyError:
+            return self.gauges.get(name, default)
+
+    def to_dict(self):
+        data = dict(self.counters)
+        data.update(self.gauges)
+        return data
+
+
+metrics = Metrics()
@@ -0,0 +1,332 @@
+"""Tick driven movement of the walking objects
+"""
+from __future__ import division
+
+import math
+
+from conf import settings
+from db import local_db
+
+from .broadphase import SweepAndPrune
+from .colliders import bodies_hash, index_bodies
+from .grids import passability
+from .metrics import metrics
+from .pathfindings import Pathfinder
+
+# px closer to the next waypoint which count as getting on
+PROGRESS = 0.1
+
+
+def _characters():
+    return local_db.get('characters', {}).values()
+
+
+class Mover(object):
+
+    __slots__ = ('obj', 'path', 'index', 'position', 'direction', 'waited',
+                 'best')
+
+    def __init__(self, obj, path):
+        self.obj = obj
+        self.path = path
+        self.index = 0
+        self.position = path[0]
+        self.direction = None
+        self.waited = 0.
+        # the furthest it got, ``(index, distance to the waypoint)``
+        self.best = (0, float('inf'))
+
+    def save(self):
+        return self.index, self.position, self.direction
+
+    def restore(self, state):
+        self.index, self.position, self.direction = state
+
+    @property
+    def finished(self):
+        return self.index >= len(self.path)
+
+
+class MovementSystem(object):
+    """Holds the path of every walking object and advances all of them in
+    one pass per simulation tick, instead of a sleeping greenlet per walk.
+
+    Paths are waypoints, walked in straight lines. Objects provide
+    ``detect_direction_and_speed(prev, next)``, which gives the direction
+    from a point to another and the seconds it takes to walk there,
+    ``_walk_steps(direction, steps)`` to apply the waypoints passed in a
+    tick followed by the point reached, ``_footpace`` for the searches of
+    the detours, and ``stop()``, called when the path is over.
+
+    Bodies run into each other are found once per tick, after all the
+    objects stepped, by a sweep and prune over the moving objects and the
+    bodies of ``collider``, indexed from ``bodies()`` first. A step bringing an object closer to a body it
+    touches is taken back and slid along the bodies instead, when that
+    way is free. An object getting no closer to its next waypoint for
+    ``wait`` seconds takes a detour around the bodies near it, an A*
+    search of at most ``detour`` nodes back to its path past them, and
+    gives up when stuck again before its goal.
+    """
+
+    def __init__(self, collider=bodies_hash, broadphase=None,
+                 wait=settings.GAME['BLOCKED_WAIT'],
+                 detour=settings.PATHFINDING['DETOUR_LIMIT'],
+                 bodies=_characters):
+        self.collider = collider
+        self.bodies = bodies
+        self.broadphase = broadphase or SweepAndPrune()
+        self.wait = wait
+        self.detour = detour
+        self.movers = {}
+        self.contacts = []
+        # {obj_id: goal} of the objects which took a detour on the way
+        self.retried = {}
+
+    def add(self, obj, path):
+        path = list(path)
+        if not path:
+            return
+        self.movers[obj.id] = Mover(obj, path)
+
+    def remove(self, obj_id):
+        self.movers.pop(obj_id, None)
+        self.retried.pop(obj_id, None)
+
+    def is_moving(self, obj_id):
+        return obj_id in self.movers
+
+    def update(self, dt):
+        # where the bodies are now, not where the last turret tick saw them
+        index_bodies(self.bodies(), self.collider)
+        moved = []
+        for mover in list(self.movers.values()):
+            state = mover.save()
+            moved.append((mover, state, self._step(mover, dt)))
+        positions = self._positions()
+        self.contacts = self.broadphase.pairs(positions)
+        metrics.gauge('movement.contacts', len(self.contacts))
+        held = self._resolve(positions, dict(
+            (mover.obj.id, state) for mover, state, _ in moved))
+        for mover, state, steps in moved:
+            obj_id = mover.obj.id
+            if obj_id in held:
+                moved_to = positions[obj_id]
+                mover.restore(state)
+                positions[obj_id] = mover.position
+                steps = self._slide(mover, moved_to, held[obj_id],
+                                    positions)
+            self._progress(mover, dt)
+            self._finish(mover, steps, positions)
+
+    def _positions(self):
+        positions = {}
+        for body in self.collider.objects.values():
+            if not body.is_dead:
+                positions[body.id] = body.coords
+        for obj_id, mover in self.movers.items():
+            positions[obj_id] = mover.position
+        return positions
+
+    def _resolve(self, positions, states):
+        """``{obj_id: [other]}`` of the objects whose step goes into bodies
+        they touch
+        """
+        held = {}
+        for pair in self.contacts:
+            for obj_id, other in (pair, pair[::-1]):
+                if obj_id not in states:
+                    continue
+                before = states[obj_id][1]
+                x, y = positions[obj_id]
+                ox, oy = positions[other]
+                if ((x - ox) ** 2 + (y - oy) ** 2 <
+                        (before[0] - ox) ** 2 + (before[1] - oy) ** 2):
+                    held.setdefault(obj_id, []).append(other)
+        if held:
+            metrics.incr('movement.held', len(held))
+        return held
+
+    def _slide(self, mover, moved_to, others, positions):
+        """Step of held ``mover`` to ``moved_to`` without the part going
+        into the bodies ``others``, the points reached or nothing when it
+        can't go that way either.
+        """
+        x, y = mover.position
+        dx, dy = moved_to[0] - x, moved_to[1] - y
+        length = math.hypot(dx, dy)
+        if not length:
+            return []
+        for other in others:
+            ox, oy = positions[other]
+            nx, ny = x - ox, y - oy
+            norm = math.hypot(nx, ny)
+            if not norm:
+                return []
+            nx, ny = nx / norm, ny / norm
+            inward = dx * nx + dy * ny
+            if inward < 0:
+                dx, dy = dx - inward * nx, dy - inward * ny
+        if math.hypot(dx, dy) < length * 1e-3:
+            # head on, step aside, to the left of the first body
+            ox, oy = positions[others[0]]
+            norm = math.hypot(x - ox, y - oy)
+            dx, dy = (oy - y) / norm * length, (x - ox) / norm * length
+        point = (x + dx, y + dy)
+        if not passability.ensure().passable(point):
+            return []
+        reach_sq = (2 * self.broadphase.radius) ** 2
+        obj_id = mover.obj.id
+        for other, (ox, oy) in positions.items():
+            if other == obj_id:
+                continue
+            distance = (point[0] - ox) ** 2 + (point[1] - oy) ** 2
+            if (distance < reach_sq and
+                    distance < (x - ox) ** 2 + (y - oy) ** 2):
+                return []
+        mover.direction, _ = mover.obj.detect_direction_and_speed(
+            mover.position, point)
+        mover.position = positions[obj_id] = point
+        metrics.incr('movement.slid')
+        return [point]
+
+    @staticmethod
+    def _progress(mover, dt):
+        """Count the time ``mover`` gets no closer to its next waypoint,
+        sliding to and fro around a body doesn't take it anywhere.
+        """
+        if mover.finished:
+            return
+        x, y = mover.position
+        waypoint = mover.path[mover.index]
+        distance = math.hypot(waypoint[0] - x, waypoint[1] - y)
+        index, best = mover.best
+        if mover.index > index or distance < best - PROGRESS:
+            mover.best = (mover.index, distance)
+            mover.waited = 0.
+        else:
+            mover.waited += dt
+
+    def _detour(self, mover, positions):
+        """Lead ``mover`` around the bodies near it back to its path, the
+        first point of it clear of them, ``False`` when there is no way
+        within ``detour`` nodes.
+        """
+        obj = mover.obj
+        reach = 2 * self.broadphase.radius
+        x, y = mover.position
+        # as far as the detour goes back to the path
+        scan = 8 * reach
+        near = [(ox, oy) for other, (ox, oy) in positions.items()
+                if other != obj.id and
+                (ox - x) ** 2 + (oy - y) ** 2 < (scan + reach) ** 2]
+        rejoin = self._rejoin(mover, near, reach, scan)
+        if rejoin is None:
+            return False
+        target, rest = rejoin
+        step = passability.ensure().step
+        blocked = set()
+        for ox, oy in near:
+            for i in range(int(ox - reach) // step,
+                           int(ox + reach) // step + 1):
+                for j in range(int(oy - reach) // step,
+                               int(oy + reach) // step + 1):
+                    if (i * step - ox) ** 2 + (j * step - oy) ** 2 < \
+                            reach * reach:
+                        blocked.add((i, j))
+        fx, fy = obj._footpace
+        goal = (int(target[0]) // fx * fx, int(target[1]) // fy * fy)
+        p = Pathfinder(obj, [], blocked=blocked)
+        p.begin_a_star()
+        if not p.expand(goal, self.detour) or goal not in p.came_from:
+            return False
+        path = list(p.reconstruct_path(goal))
+        metrics.incr('movement.detour.expanded', p.expanded)
+        if settings.PATHFINDING['SMOOTH']:
+            path = Pathfinder.smooth(path, blocked=blocked)
+        path.reverse()
+        mover.path = [mover.position] + path[1:] + rest
+        mover.index = 0
+        mover.best = (0, float('inf'))
+        mover.waited = 0.
+        return True
+
+    @staticmethod
+    def _rejoin(mover, near, reach, scan):
+        """``(point, rest of the path)`` of the first point of the path
+        of ``mover`` ``reach`` px clear of the bodies ``near``, looked for
+        every ``reach`` px up to ``scan`` px on, the goal past that.
+        """
+        clear_sq = (2 * reach) ** 2
+        path = mover.path
+        a = mover.position
+        # px along the path from the position, to the next point looked at
+        # and to the start of the segment
+        distance, walked = reach, 0.
+        for index in range(mover.index, len(path)):
+            b = path[index]
+            length = math.hypot(b[0] - a[0], b[1] - a[1])
+            while distance <= walked + length and distance <= scan:
+                part = (distance - walked) / length
+                point = (a[0] + (b[0] - a[0]) * part,
+                         a[1] + (b[1] - a[1]) * part)
+                if (distance >= 2 * reach and
+                        all((point[0] - ox) ** 2 + (point[1] - oy) ** 2 >=
+                            clear_sq for ox, oy in near)):
+                    return point, path[index:]
+                distance += reach
+            if distance > scan:
+                break
+            walked += length
+            a = b
+        goal = path[-1]
+        if all((goal[0] - ox) ** 2 + (goal[1] - oy) ** 2 >= clear_sq
+               for ox, oy in near):
+            return goal, []
+        return None
+
+    def _step(self, mover, dt):
+        """Advance ``mover`` by ``dt``, the points passed and reached"""
+        obj, path = mover.obj, mover.path
+        steps = []
+        while not mover.finished:
+            waypoint = path[mover.index]
+            direction, seconds = obj.detect_direction_and_speed(
+                mover.position, waypoint)
+            if mover.position != waypoint:
+                mover.direction = direction
+            if seconds > dt:
+                # stop on the way to the waypoint
+                part = dt / seconds
+                x, y = mover.position
+                mover.position = (x + (waypoint[0] - x) * part,
+                                  y + (waypoint[1] - y) * part)
+                steps.append(mover.position)
+                break
+            dt -= seconds
+            mover.position = waypoint
+            mover.index += 1
+            steps.append(waypoint)
+        return steps
+
+    def _finish(self, mover, steps, positions):
+        obj = mover.obj
+        if steps and mover.direction is not None:
+            obj._walk_steps(mover.direction, steps)
+        # the object may have been stopped while walking
+        if self.movers.get(obj.id) is not mover:
+            return
+        if mover.finished:
+            self.remove(obj.id)
+            obj.stop()
+        elif mover.waited >= self.wait:
+            goal = mover.path[-1]
+            if (self.retried.get(obj.id) != goal and
+                    self._detour(mover, positions)):
+                self.retried[obj.id] = goal
+                metrics.incr('movement.detours')
+                return
+            self.remove(obj.id)
+            obj.stop()
+
+
+movement = MovementSystem()
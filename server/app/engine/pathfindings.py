@@ -3,9 +3,13 @@ import heapq
 import constants as const
 
 from conf import settings
-from db import local_db
 
-from .colliders import spatial_hash
+from .caches import LRUCache
+from .clusters import cluster_graph, octile
+from .flowfields import flow_fields
+from .grids import passability
+from .metrics import metrics
+from .replanners import DStarLite
 
 
 class PriorityQueue(object):
@@ -23,6 +27,10 @@ class PriorityQueue(object):
         return heapq.heappop(self.elements)[1]
 
 
+path_cache = LRUCache('pathfinding.cache',
+                      settings.PATHFINDING['CACHE_SIZE'])
+
+
 class Pathfinder(object):
 
     dir_funcs = {
@@ -37,13 +45,21 @@ class Pathfinder(object):
         const.Direction.NW: lambda p, s: (p[0] + s[0], p[1] - s[1]),
     }
 
-    def __init__(self, obj, chop_directions):
+    def __init__(self, obj, chop_directions, grid=passability, blocked=()):
         self.queue = PriorityQueue()
         self.obj = obj
+        self.grid = grid
+        # nodes closed on top of the grid for A*, e.g. by bodies
+        self.blocked = blocked
         self.came_from = {}
         self.cost_so_far = {}
         self.chop_directions = chop_directions
         self.start = self._get_nearest_multiple_point(obj)
+        self.expanded = 0
+        self._deltas = {
+            direction: func((0, 0), obj._footpace)
+            for direction, func in self.dir_funcs.items()
+        }
 
     @staticmethod
     def _centralize_cell(cell, cell_size=settings.GAME['CELL_SIZE']):
@@ -51,29 +67,31 @@ class Pathfinder(object):
         y = int((cell[1] // cell_size) * cell_size)
         return (x + cell_size / 2, y + cell_size / 2)
 
-    def _possible_steps(self, point, goal):
-        steps = []
-        for direction in self._aesthetics_directions(point, goal):
-            try:
-                steps.append(self.dir_funcs[direction](point,
-                                                       self.obj._footpace))
-            except KeyError:
-                pass
-        return steps
-
     @staticmethod
     def passable(point):
-        return not spatial_hash.is_predict_point_collide(point)
+        return passability.passable(point)
 
     @staticmethod
     def in_bounds(point):
-        from .colliders import spatial_hash
-        return spatial_hash.in_bounds(point)
+        return passability.in_bounds(point)
 
     def get_neighbors(self, point, goal):
-        steps = self._possible_steps(point, goal)
-        steps = filter(self.in_bounds, steps)
-        return filter(self.passable, steps)
+        grid = self.grid
+        cells, step, width = grid.cells, grid.step, grid.width
+        max_x, max_y = grid.map_width, grid.map_height
+        blocked = self.blocked
+        px, py = point
+        neighbors = []
+        for direction in self._aesthetics_directions(point, goal):
+            dx, dy = self._deltas[direction]
+            x = px + dx
+            y = py + dy
+            if (0 <= x < max_x and 0 <= y < max_y and
+                    cells[int(y) // step * width + int(x) // step] and
+                    not (blocked and
+                         (int(x) // step, int(y) // step) in blocked)):
+                neighbors.append((x, y))
+        return neighbors
 
     def _aesthetics_directions(self, point, goal):
         if point[0] <= goal[0] and point[1] <= goal[1]:
@@ -196,6 +214,7 @@ class Pathfinder(object):
 
         while not frontier.empty():
             current = frontier.get()
+            self.expanded += 1
 
             if current == goal:
                 break
@@ -207,17 +226,34 @@ class Pathfinder(object):
                     self.came_from[next] = current
 
     def a_star_search(self, goal):
-        frontier = PriorityQueue()
-        frontier.put(self.start, 0)
+        self.begin_a_star()
+        self.expand(goal)
+
+    def begin_a_star(self):
+        """Start an A* search to be run by ``expand``"""
+        self.frontier = PriorityQueue()
+        self.frontier.put(self.start, 0)
         self.came_from = {}
         self.cost_so_far = {}
         self.came_from[self.start] = None
         self.cost_so_far[self.start] = 0
 
+    def expand(self, goal, limit=None):
+        """Go on with the started A* for at most ``limit`` nodes.
+
+        Returns ``True`` once the search is over.
+        """
+        frontier = self.frontier
+        expanded = 0
         while not frontier.empty():
+            if limit is not None and expanded >= limit:
+                return False
             current = frontier.get()
+            self.expanded += 1
+            expanded += 1
 
             if current == goal:
+                frontier.elements = []
                 break
 
             for next in self.get_neighbors(current, goal):
@@ -229,6 +265,238 @@ class Pathfinder(object):
                     priority = new_cost + self.heuristic(goal, next)
                     frontier.put(next, priority)
                     self.came_from[next] = current
+        return True
+
+    def _open(self, i, j):
+        grid = self.grid
+        return (0 <= i < grid.width and 0 <= j < grid.height and
+                grid.cells[j * grid.width + i] == 1)
+
+    def _jump(self, i, j, di, dj, goal):
+        """Walk from node ``(i, j)`` in one direction until a jump point,
+        every node walked counts as expanded.
+        """
+        is_open = self._open
+        grid = self.grid
+        cells, width, height = grid.cells, grid.width, grid.height
+        while True:
+            i += di
+            j += dj
+            self.expanded += 1
+            if not (0 <= i < width and 0 <= j < height and
+                    cells[j * width + i] == 1):
+                return None
+            if (i, j) == goal:
+                return (i, j)
+            if di and dj:
+                if ((is_open(i - di, j + dj) and not is_open(i - di, j)) or
+                        (is_open(i + di, j - dj) and not is_open(i, j - dj))):
+                    return (i, j)
+                if (self._jump(i, j, di, 0, goal) or
+                        self._jump(i, j, 0, dj, goal)):
+                    return (i, j)
+            elif di:
+                if ((is_open(i + di, j + 1) and not is_open(i, j + 1)) or
+                        (is_open(i + di, j - 1) and not is_open(i, j - 1))):
+                    return (i, j)
+            else:
+                if ((is_open(i + 1, j + dj) and not is_open(i + 1, j)) or
+                        (is_open(i - 1, j + dj) and not is_open(i - 1, j))):
+                    return (i, j)
+
+    def _jump_directions(self, node, parent):
+        if parent is None:
+            return [(di, dj) for di, dj, _ in self._moves()]
+        i, j = node
+        di = (i > parent[0]) - (i < parent[0])
+        dj = (j > parent[1]) - (j < parent[1])
+        is_open = self._open
+        if di and dj:
+            directions = [(di, 0), (0, dj), (di, dj)]
+            if not is_open(i - di, j):
+                directions.append((-di, dj))
+            if not is_open(i, j - dj):
+                directions.append((di, -dj))
+        elif di:
+            directions = [(di, 0)]
+            if not is_open(i, j + 1):
+                directions.append((di, 1))
+            if not is_open(i, j - 1):
+                directions.append((di, -1))
+        else:
+            directions = [(0, dj)]
+            if not is_open(i + 1, j):
+                directions.append((1, dj))
+            if not is_open(i - 1, j):
+                directions.append((-1, dj))
+        return directions
+
+    def jump_point_search(self, goal):
+        """A* that only queues the jump points of the open terrain.
+
+        ``expanded`` counts the nodes scanned while jumping, comparable
+        with the ones of A*, ``jump_points`` the nodes taken from the
+        queue. The symmetry pruning relies on all the 8 moves being
+        allowed, so with chopped directions it is plain A*.
+        """
+        self.jump_points = 0
+        if self.chop_directions:
+            self.a_star_search(goal)
+            return list(self.reconstruct_path(goal))
+
+        step = self.grid.step
+        start = (int(self.start[0]) // step, int(self.start[1]) // step)
+        goal_node = (int(goal[0]) // step, int(goal[1]) // step)
+        frontier = PriorityQueue()
+        frontier.put(start, 0)
+        came_from = {start: None}
+        cost_so_far = {start: 0}
+
+        while not frontier.empty():
+            current = frontier.get()
+            self.jump_points += 1
+
+            if current == goal_node:
+                break
+
+            for di, dj in self._jump_directions(current,
+                                                came_from[current]):
+                next = self._jump(current[0], current[1], di, dj, goal_node)
+                if next is None:
+                    continue
+                new_cost = cost_so_far[current] + octile(current, next)
+                if (next not in cost_so_far or
+                   new_cost < cost_so_far[next]):
+                    cost_so_far[next] = new_cost
+                    priority = new_cost + octile(next, goal_node)
+                    frontier.put(next, priority)
+                    came_from[next] = current
+
+        if came_from.get(goal_node) is None:
+            return []
+        # jump points are joined by straight or diagonal runs, expand them
+        # back to single steps
+        path = [goal]
+        current = goal_node
+        while came_from[current] is not None:
+            prev = came_from[current]
+            di = (prev[0] > current[0]) - (prev[0] < current[0])
+            dj = (prev[1] > current[1]) - (prev[1] < current[1])
+            node = current
+            while node != prev:
+                node = (node[0] + di, node[1] + dj)
+                path.append((node[0] * step, node[1] * step))
+            current = prev
+        path[-1] = self.start
+        return path
+
+    def _moves(self):
+        """Allowed moves as ``(di, dj, cost)`` in grid nodes"""
+        moves = []
+        for direction, func in self.dir_funcs.items():
+            if direction in self.chop_directions:
+                continue
+            di, dj = func((0, 0), (1, 1))
+            moves.append((di, dj, math.sqrt(di * di + dj * dj)))
+        return sorted(moves)
+
+    def hierarchical_search(self, goal):
+        step = self.grid.step
+        start = (int(self.start[0]) // step, int(self.start[1]) // step)
+        goal_node = (int(goal[0]) // step, int(goal[1]) // step)
+        graph = cluster_graph.ensure()
+        if not graph.in_grid(start):
+            # no cluster to start from, plain search steps into the map
+            self.a_star_search(goal)
+            return list(self.reconstruct_path(goal))
+
+        nodes = graph.search(start, goal_node, self._moves())
+        self.expanded += graph.expanded
+        if not nodes:
+            return []
+        path = [(i * step, j * step) for i, j in nodes]
+        path[0] = self.start
+        path[-1] = goal
+        path.reverse()
+        return path
+
+    def flow_search(self, goal):
+        """Path along the flow field of the goal, shared with the other
+        walkers going there, it is only expanded as far as the start.
+        """
+        step = self.grid.step
+        start = (int(self.start[0]) // step, int(self.start[1]) // step)
+        goal_node = (int(goal[0]) // step, int(goal[1]) // step)
+        if not self._open(*start):
+            # the field only covers the open nodes
+            self.a_star_search(goal)
+            return list(self.reconstruct_path(goal))
+
+        field = flow_fields.get(goal_node, self._moves())
+        self.expanded += field.expand(until=start)
+        nodes = field.path(start)
+        if len(nodes) < 2:
+            return []
+        path = [(i * step, j * step) for i, j in nodes]
+        path[0] = self.start
+        path[-1] = goal
+        path.reverse()
+        return path
+
+    @staticmethod
+    def smooth(path, grid=passability, blocked=()):
+        """Waypoints of ``path``, still from the goal back to the start.
+
+        Runs of steps in one direction are collapsed to their ends, then
+        every corner the previous waypoint has a line of sight past is
+        dropped. ``blocked`` nodes are taken as obstacles too.
+        """
+        path = list(path)
+        if len(path) < 3:
+            return path
+        corners = [path[0]]
+        for prev, point, next in zip(path, path[1:], path[2:]):
+            if ((point[0] - prev[0]) * (next[1] - point[1]) !=
+                    (point[1] - prev[1]) * (next[0] - point[0])):
+                corners.append(point)
+        corners.append(path[-1])
+
+        waypoints = [corners[0]]
+        for prev, point in zip(corners[1:], corners[2:]):
+            if not grid.line_of_sight(waypoints[-1], point, blocked):
+                waypoints.append(prev)
+        waypoints.append(corners[-1])
+        metrics.incr('pathfinding.smooth.dropped', len(path) - len(waypoints))
+        return waypoints
+
+    def begin_d_star(self, goal, blocked=()):
+        """D* Lite search kept in ``self.dstar``, nothing searched yet"""
+        step = self.grid.step
+        start = (int(self.start[0]) // step, int(self.start[1]) // step)
+        goal_node = (int(goal[0]) // step, int(goal[1]) // step)
+        limit = (settings.PATHFINDING['REPLAN_LIMIT'] *
+                 self.grid.width * self.grid.height)
+        self.dstar = DStarLite(self.grid, start, goal_node, self._moves(),
+                               blocked, limit)
+
+    def d_star_search(self, goal, blocked=()):
+        """D* Lite search, kept in ``self.dstar`` to be repaired later"""
+        self.begin_d_star(goal, blocked)
+        return self.d_star_path(goal)
+
+    def d_star_path(self, goal):
+        """Path of the ``begin_d_star`` search, searched to the end"""
+        step = self.grid.step
+        expanded = self.dstar.expanded
+        nodes = self.dstar.path()
+        self.expanded += self.dstar.expanded - expanded
+        if len(nodes) < 2:
+            return []
+        path = [(i * step, j * step) for i, j in nodes]
+        path[0] = self.start
+        path[-1] = goal
+        path.reverse()
+        return path
 
     def reconstruct_path(self, goal):
         if not self.came_from.get(goal):
@@ -249,19 +517,93 @@ class Pathfinder(object):
                       for i, t in enumerate(tmp)])
 
     @classmethod
-    def build_path(cls, obj, goal, alg='A*', chop_directions=None):
+    def plan(cls, obj, goal, alg='A*', chop_directions=None, cached=True):
+        """``(pathfinder, goal, path)`` for a trip of ``obj`` to ``goal``.
+
+        ``path`` is the cached one or ``None`` when it has to be searched
+        with ``pathfinder.search(goal, alg)``. Unreachable goals give no
+        pathfinder and an empty path.
+        """
         if chop_directions is None:
             chop_directions = []
         if (not goal[0] or not goal[1]):
-            return []
+            return None, goal, []
 
         goal = cls._centralize_cell(goal)
+        passability.ensure()
         # check if clicked point has no collision
         if not cls.passable(goal) or not cls.in_bounds(goal):
-            return []
+            return None, goal, []
         p = Pathfinder(obj, chop_directions)
+        if not cached:
+            return p, goal, None
+        path = path_cache.get(p.cache_key(goal, alg), passability.version,
+                              convert=p.join)
+        return p, goal, path
+
+    @classmethod
+    def build_path(cls, obj, goal, alg='A*', chop_directions=None):
+        p, goal, path = cls.plan(obj, goal, alg, chop_directions)
+        if path is None:
+            path = tuple(p.search(goal, alg))
+            path_cache.put(p.cache_key(goal, alg), passability.version, path)
+        return list(path)
+
+    def cache_key(self, goal, alg, cell_size=settings.GAME['CELL_SIZE']):
+        # the trips from anywhere in the start cell to the same cell share
+        # one entry, ``join`` leads it to the exact start
+        start_cell = (int(self.start[0] // cell_size),
+                      int(self.start[1] // cell_size))
+        return (start_cell, goal, tuple(sorted(set(self.chop_directions))),
+                alg)
+
+    def join(self, path, cell_size=settings.GAME['CELL_SIZE']):
+        """Cached ``path`` of another start in the start cell cut at its
+        point closest to the start seen in a straight line, and ended by
+        the start. ``None`` when there is no such point near the start.
+        """
+        start = self.start
+        if not path or path[-1] == start:
+            return path if path else None
+        if self.chop_directions:
+            # a straight join may take a chopped direction
+            return None
+        reach = 2 * cell_size
+        for k in range(len(path) - 1, -1, -1):
+            point = path[k]
+            if (abs(point[0] - start[0]) > reach or
+                    abs(point[1] - start[1]) > reach):
+                break
+            if self.grid.line_of_sight(start, point):
+                return tuple(path[:k + 1]) + (start,)
+        return None
+
+    def search(self, goal, alg='A*'):
+        """Path from ``goal`` back to the start"""
         if alg == 'A*':
-            p.a_star_search(goal)
+            self.a_star_search(goal)
         elif alg == 'BFS':
-            p.g_bfs_search(goal)
-        return p.reconstruct_path(goal)
+            self.g_bfs_search(goal)
+        elif alg == 'HPA*':
+            path = self.hierarchical_search(goal)
+            self._count(alg)
+            return path
+        elif alg == 'D*':
+            path = self.d_star_search(goal)
+            self._count(alg)
+            return path
+        elif alg == 'FLOW':
+            path = self.flow_search(goal)
+            self._count(alg)
+            return path
+        elif alg == 'JPS':
+            path = self.jump_point_search(goal)
+            self._count(alg)
+            metrics.incr('pathfinding.JPS.jump_points', self.jump_points)
+            return path
+        self._count(alg)
+        return list(self.reconstruct_path(goal))
+
+    def _count(self, alg):
+        metrics.incr('pathfinding.%s.searches' % alg)
+        metrics.incr('pathfinding.%s.expanded' % alg, self.expanded)
@@ -0,0 +1,582 @@
+"""Path requests answered out of the calling greenlet
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict
+
+from conf import settings
+
+from .clusters import cluster_graph
+from .colliders import bodies_hash
+from .flowfields import flow_fields
+from .grids import FrozenGrid, passability
+from .loop import clock
+from .metrics import metrics
+from .movements import movement
+from .pathfindings import Pathfinder, path_cache
+
+
+class Walker(object):
+    """What a ``Pathfinder`` needs to know about a character, picklable"""
+
+    __slots__ = ('coords', '_footpace')
+
+    def __init__(self, coords, footpace):
+        self.coords = tuple(coords)
+        self._footpace = tuple(footpace)
+
+    def __getstate__(self):
+        return (self.coords, self._footpace)
+
+    def __setstate__(self, state):
+        self.coords, self._footpace = state
+
+
+class PathPlanner(object):
+    """Searches paths right away, in the greenlet asking for them.
+
+    ``request(obj, goal, callback)`` passes the path (from ``goal`` back
+    to the start) to ``callback``, smoothed into waypoints when the
+    ``SMOOTH`` setting is on. A new request of the same object
+    supersedes its previous one, ``cancel(obj_id)`` drops it. Planners
+    answering later do it from ``update(dt)``, run every simulation tick.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def request(self, obj, goal, callback, alg='A*', chop_directions=None):
+        self._finish(callback,
+                     Pathfinder.build_path(obj, goal, alg, chop_directions))
+
+    def cancel(self, obj_id):
+        pass
+
+    def is_planning(self, obj_id):
+        return False
+
+    def update(self, dt=None):
+        pass
+
+    def _finish(self, callback, path, blocked=()):
+        path = list(path)
+        if settings.PATHFINDING['SMOOTH']:
+            path = Pathfinder.smooth(path, blocked=blocked)
+        callback(path)
+
+
+class PathRequest(object):
+
+    __slots__ = ('id', 'obj_id', 'callback', 'key', 'version', 'worker',
+                 'pathfinder', 'goal')
+
+    def __init__(self, id, obj_id, callback, key, version, worker=None,
+                 pathfinder=None, goal=None):
+        self.id = id
+        self.obj_id = obj_id
+        self.callback = callback
+        self.key = key
+        self.version = version
+        self.worker = worker
+        self.pathfinder = pathfinder
+        self.goal = goal
+
+
+class Worker(object):
+    """Process searching paths on its own copy of the passability grid"""
+
+    def __init__(self):
+        # one way pipes, a duplex one is a socket pair, which is left non
+        # blocking by the gevent patched socket module
+        inbox, self.outbox = multiprocessing.Pipe(duplex=False)
+        self.results, results = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(inbox, results))
+        self.process.daemon = True
+        self.process.start()
+        inbox.close()
+        results.close()
+        self.grid_key = None
+        self.grid_file = None
+        self.requests = set()
+
+    def send(self, *message):
+        self.outbox.send(message)
+
+    def send_grid(self, frozen):
+        """Pass a ``PassabilityGrid.freeze`` copy through a file, the grid
+        doesn't fit the pipe buffer and a write to a busy worker would
+        block the hub until its search is over.
+        """
+        key, step, map_width, map_height, cells = frozen
+        fd, path = tempfile.mkstemp(prefix='boxer-grid-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cells)
+            self.send('grid', key, step, map_width, map_height, path)
+        except Exception:
+            # nobody is going to read it
+            os.remove(path)
+            raise
+        self.grid_file = path
+
+    def stop(self):
+        try:
+            self.send('stop')
+        except (IOError, OSError):
+            pass
+        self.outbox.close()
+        self.results.close()
+        self.process.join(1)
+        if self.grid_file:
+            try:
+                os.remove(self.grid_file)
+            except (IOError, OSError):
+                # the worker removed it once read
+                pass
+
+
+def serve(inbox, results):
+    """Main loop of a ``Worker`` process"""
+    grid = None
+    queue = []
+    cancelled = set()
+    while True:
+        if not queue or inbox.poll():
+            try:
+                message = inbox.recv()
+            except EOFError:
+                return
+            if message[0] == 'grid':
+                key, step, map_width, map_height, path = message[1:]
+                try:
+                    with open(path, 'rb') as f:
+                        cells = f.read()
+                finally:
+                    os.remove(path)
+                grid = FrozenGrid(key, step, map_width, map_height, cells)
+                cluster_graph.grid = grid
+                flow_fields.grid = grid
+                flow_fields.fields = {}
+            elif message[0] == 'search':
+                queue.append(message[1:])
+            elif message[0] == 'cancel':
+                cancelled.add(message[1])
+            elif message[0] == 'stop':
+                return
+            continue
+
+        request_id, walker, goal, chop_directions, alg = queue.pop(0)
+        if request_id in cancelled:
+            cancelled.discard(request_id)
+            continue
+        p = Pathfinder(walker, chop_directions, grid=grid)
+        path = p.search(goal, alg)
+        results.send(('path', request_id, list(path), p.expanded))
+
+
+class ProcessPlanner(PathPlanner):
+    """Sends the searches to a pool of ``Worker`` processes.
+
+    The workers get the grid again whenever its version changes. Cached
+    paths are still answered right away, the rest is collected by
+    ``update`` once the worker is done.
+    """
+
+    def __init__(self, size=settings.PATHFINDING['WORKERS']):
+        self.size = size
+        self.workers = []
+        self.requests = {}
+        self.by_obj = {}
+        self._ids = itertools.count(1)
+
+    def start(self):
+        while len(self.workers) < self.size:
+            self.workers.append(Worker())
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def request(self, obj, goal, callback, alg='A*', chop_directions=None):
+        self.cancel(obj.id)
+        p, goal, path = Pathfinder.plan(obj, goal, alg, chop_directions)
+        if path is not None:
+            self._finish(callback, path)
+            return
+
+        self.start()
+        worker = min(self.workers, key=lambda w: len(w.requests))
+        version = passability.version
+        if worker.grid_key != version:
+            worker.send_grid(passability.freeze())
+            worker.grid_key = version
+        request = PathRequest(next(self._ids), obj.id, callback,
+                              p.cache_key(goal, alg), version, worker)
+        worker.send('search', request.id, Walker(p.start, obj._footpace),
+                    goal, p.chop_directions, alg)
+        worker.requests.add(request.id)
+        self.requests[request.id] = request
+        self.by_obj[obj.id] = request.id
+        metrics.incr('pathfinding.workers.requests')
+
+    def cancel(self, obj_id):
+        request = self._pop(self.by_obj.get(obj_id))
+        if request is None:
+            return
+        try:
+            request.worker.send('cancel', request.id)
+        except (IOError, OSError):
+            pass
+        metrics.incr('pathfinding.workers.cancelled')
+
+    def is_planning(self, obj_id):
+        return obj_id in self.by_obj
+
+    def _pop(self, request_id):
+        request = self.requests.pop(request_id, None)
+        if request is not None:
+            request.worker.requests.discard(request_id)
+            if self.by_obj.get(request.obj_id) == request_id:
+                del self.by_obj[request.obj_id]
+        return request
+
+    def update(self, dt=None):
+        for worker in list(self.workers):
+            try:
+                while worker.results.poll():
+                    self._deliver(*worker.results.recv()[1:])
+            except (EOFError, IOError, OSError):
+                logging.exception('Pathfinding worker is gone')
+                self._replace(worker)
+
+    def _deliver(self, request_id, path, expanded):
+        request = self._pop(request_id)
+        metrics.incr('pathfinding.workers.expanded', expanded)
+        if request is None:
+            # superseded while the worker was busy with it
+            return
+        if request.version == passability.version:
+            path_cache.put(request.key, request.version, tuple(path))
+        self._finish(request.callback, path)
+
+    def _replace(self, worker):
+        self.workers.remove(worker)
+        worker.stop()
+        for request_id in list(worker.requests):
+            self._finish(self._pop(request_id).callback, [])
+        self.start()
+
+
+class SlicedPlanner(PathPlanner):
+    """Runs the A* searches a few nodes at a time from ``update``.
+
+    Every pending search gets at most ``slice`` nodes per tick and all of
+    them together at most ``budget``, shared evenly, and no new slice is
+    started after ``time_budget`` seconds of the tick. Searches left out
+    of a tick go first on the next one. The other algorithms are cheap
+    enough to run right away.
+    """
+
+    def __init__(self, slice=settings.PATHFINDING['SLICE'],
+                 budget=settings.PATHFINDING['BUDGET'],
+                 time_budget=settings.PATHFINDING['SLICE_TIME']):
+        self.slice = slice
+        self.budget = budget
+        self.time_budget = time_budget
+        self.pending = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def request(self, obj, goal, callback, alg='A*', chop_directions=None):
+        self.cancel(obj.id)
+        if alg != 'A*':
+            return super(SlicedPlanner, self).request(
+                obj, goal, callback, alg, chop_directions)
+        p, goal, path = Pathfinder.plan(obj, goal, alg, chop_directions)
+        if path is not None:
+            self._finish(callback, path)
+            return
+
+        p.begin_a_star()
+        self.pending[obj.id] = PathRequest(
+            next(self._ids), obj.id, callback, p.cache_key(goal, alg),
+            passability.version, pathfinder=p, goal=goal)
+
+    def cancel(self, obj_id):
+        self.pending.pop(obj_id, None)
+
+    def is_planning(self, obj_id):
+        return obj_id in self.pending
+
+    def update(self, dt=None):
+        if not self.pending:
+            return
+        passability.ensure()
+        budget = self.budget
+        share = min(self.slice, max(1, budget // len(self.pending)))
+        deadline = clock() + self.time_budget
+        for obj_id in list(self.pending):
+            if budget <= 0 or clock() >= deadline:
+                break
+            # to the end of the line
+            request = self.pending.pop(obj_id)
+            p = request.pathfinder
+            if request.version != passability.version:
+                # the map changed under the search
+                p.begin_a_star()
+                request.version = passability.version
+            expanded = p.expanded
+            done = p.expand(request.goal, min(share, budget))
+            budget -= p.expanded - expanded
+            if not done:
+                self.pending[obj_id] = request
+                continue
+            p._count('A*')
+            path = tuple(p.reconstruct_path(request.goal))
+            path_cache.put(request.key, request.version, path)
+            self._finish(request.callback, path)
+        metrics.incr('pathfinding.sliced.expanded', self.budget - budget)
+        metrics.gauge('pathfinding.sliced.pending', len(self.pending))
+
+
+class Route(object):
+
+    __slots__ = ('obj', 'goal', 'callback', 'chop_directions', 'pathfinder',
+                 'version', 'nodes', 'blocked', 'searching', 'repairing')
+
+    def __init__(self, obj, goal, callback, chop_directions, pathfinder,
+                 version, blocked):
+        self.obj = obj
+        self.goal = goal
+        self.callback = callback
+        self.chop_directions = chop_directions
+        self.pathfinder = pathfinder
+        self.version = version
+        self.nodes = set()
+        self.blocked = blocked
+        self.searching = True
+        self.repairing = False
+
+    @property
+    def dstar(self):
+        return self.pathfinder.dstar
+
+
+class Replanner(PathPlanner):
+    """Keeps the D* Lite search of every walking object and repairs its
+    path when bodies of ``collider`` get on the part still to walk.
+
+    Bodies block the nodes within two ``radius`` px of their coords, the
+    distance at which ``movement`` finds them touching a walker. Nodes
+    freed by the bodies are only taken into account by the next repair.
+
+    The first search of a route and its repairs are run by ``update``
+    like the searches of ``SlicedPlanner``, at most ``slice`` nodes of one
+    per tick, ``budget`` nodes of all of them and no new slice after
+    ``time_budget`` seconds. The object walks its old path until the
+    repair is over, a repair going past ``repair_limit`` nodes is given
+    up and the object left to ``movement``. A first search going past
+    its limit is handed over to a ``SlicedPlanner`` A* search, the path
+    is walked without repairs then.
+    """
+
+    def __init__(self, collider=bodies_hash,
+                 radius=settings.PATHFINDING['BODY_RADIUS'],
+                 slice=settings.PATHFINDING['SLICE'],
+                 budget=settings.PATHFINDING['BUDGET'],
+                 time_budget=settings.PATHFINDING['SLICE_TIME'],
+                 repair_limit=settings.PATHFINDING['REPAIR_LIMIT']):
+        self.collider = collider
+        self.radius = radius
+        self.slice = slice
+        self.budget = budget
+        self.time_budget = time_budget
+        self.repair_limit = repair_limit
+        self.routes = {}
+        self.fallback = SlicedPlanner(slice, budget, time_budget)
+
+    def request(self, obj, goal, callback, alg='D*', chop_directions=None):
+        self.cancel(obj.id)
+        p, goal, _ = Pathfinder.plan(obj, goal, alg, chop_directions,
+                                     cached=False)
+        if p is None:
+            self._finish(callback, [])
+            return
+        blocked = self._blocked(self._occupied(), obj)
+        p.begin_d_star(goal, blocked)
+        self.routes[obj.id] = Route(obj, goal, callback, chop_directions, p,
+                                    passability.version, blocked)
+
+    def cancel(self, obj_id):
+        self.routes.pop(obj_id, None)
+        self.fallback.cancel(obj_id)
+
+    def is_planning(self, obj_id):
+        route = self.routes.get(obj_id)
+        return ((route is not None and route.searching) or
+                self.fallback.is_planning(obj_id))
+
+    def update(self, dt=None):
+        self.fallback.update(dt)
+        if not self.routes:
+            return
+        passability.ensure()
+        self._search()
+        occupied = self._occupied()
+        for obj_id, route in list(self.routes.items()):
+            if route.searching:
+                continue
+            if not movement.is_moving(obj_id):
+                del self.routes[obj_id]
+            elif route.version != passability.version:
+                # the map itself changed, nothing to reuse
+                self.request(route.obj, route.goal, route.callback, 'D*',
+                             route.chop_directions)
+            elif not route.repairing and self._obstructed(route, occupied):
+                self._repair(route, occupied)
+
+    def _search(self):
+        """Go on with the first searches and the repairs of the routes"""
+        searching = [route for route in self.routes.values()
+                     if route.searching or route.repairing]
+        if not searching:
+            return
+        budget = self.budget
+        share = min(self.slice, max(1, budget // len(searching)))
+        deadline = clock() + self.time_budget
+        for route in searching:
+            if budget <= 0 or clock() >= deadline:
+                break
+            obj_id = route.obj.id
+            p = route.pathfinder
+            if route.version != passability.version:
+                # the map changed under the search
+                self.request(route.obj, route.goal, route.callback, 'D*',
+                             route.chop_directions)
+                continue
+            expanded = route.dstar.expanded
+            done = route.dstar.compute(min(share, budget))
+            spent = route.dstar.expanded - expanded
+            budget -= spent
+            if route.repairing:
+                metrics.incr('pathfinding.D*.expanded', spent)
+                if done is not None:
+                    self._repaired(route, done)
+                continue
+            p.expanded += spent
+            if done is None:
+                continue
+            route.searching = False
+            path = p.d_star_path(route.goal) if done else []
+            p._count('D*')
+            if done is False:
+                del self.routes[obj_id]
+                metrics.incr('pathfinding.D*.given_up')
+                self.fallback.request(route.obj, route.goal, route.callback,
+                                      'A*', route.chop_directions)
+                continue
+            if not path:
+                del self.routes[obj_id]
+                self._finish(route.callback, [])
+                continue
+            self._deliver(route, path, route.blocked)
+        metrics.gauge('pathfinding.D*.searching',
+                      sum(1 for route in self.routes.values()
+                          if route.searching))
+        metrics.gauge('pathfinding.D*.repairing',
+                      sum(1 for route in self.routes.values()
+                          if route.repairing))
+
+    def _occupied(self):
+        """Nodes covered by the bodies, with the ids of the bodies"""
+        step = passability.step
+        reach = 2 * self.radius
+        reach_sq = reach * reach
+        occupied = {}
+        for body in self.collider.objects.values():
+            x, y = body.coords
+            for i in range(int(x - reach) // step,
+                           int(x + reach) // step + 1):
+                for j in range(int(y - reach) // step,
+                               int(y + reach) // step + 1):
+                    if (i * step - x) ** 2 + (j * step - y) ** 2 < reach_sq:
+                        occupied.setdefault((i, j), set()).add(body.id)
+        return occupied
+
+    @staticmethod
+    def _blocked(occupied, obj):
+        return set(node for node, ids in occupied.items()
+                   if ids != set([obj.id]))
+
+    def _obstructed(self, route, occupied):
+        obj_id = route.obj.id
+        if not any(ids != set([obj_id])
+                   for node, ids in occupied.items() if node in route.nodes):
+            return False
+        # is it still ahead
+        mover = movement.movers[obj_id]
+        points = [mover.position] + mover.path[mover.index:]
+        blocked = self._blocked(occupied, route.obj)
+        return any(node in blocked
+                   for a, b in zip(points, points[1:])
+                   for node in passability.traverse(a, b))
+
+    def _repair(self, route, occupied):
+        """Start repairing the search of ``route``, ``_search`` goes on"""
+        obj = route.obj
+        step = passability.step
+        route.blocked = self._blocked(occupied, obj)
+        route.repairing = True
+        dstar = route.dstar
+        dstar.limit = self.repair_limit
+        dstar.move_to((int(obj.coords[0]) // step, int(obj.coords[1]) // step))
+        dstar.set_blocked(route.blocked)
+        metrics.incr('pathfinding.replans')
+
+    def _repaired(self, route, done):
+        obj = route.obj
+        step = passability.step
+        route.repairing = False
+        if not done:
+            # too far around, keep the old path, movement slides or
+            # asks again for the bodies still in the way
+            del self.routes[obj.id]
+            metrics.incr('pathfinding.replans.given_up')
+            return
+        nodes = route.dstar.path()
+        if len(nodes) < 2:
+            # walled in, wait for a new move
+            del self.routes[obj.id]
+            movement.remove(obj.id)
+            obj.stop()
+            return
+        path = [(i * step, j * step) for i, j in nodes]
+        path[0] = obj.coords
+        path[-1] = route.goal
+        path.reverse()
+        self._deliver(route, path, route.blocked)
+
+    def _deliver(self, route, path, blocked):
+        def _callback(waypoints):
+            route.nodes = set(
+                node for a, b in zip(waypoints, waypoints[1:])
+                for node in passability.traverse(a, b))
+            route.callback(waypoints)
+        self._finish(_callback, path, blocked)
+
+
+if settings.PATHFINDING['PLANNER'] == 'processes':
+    planner = ProcessPlanner()
+elif settings.PATHFINDING['PLANNER'] == 'sliced':
+    planner = SlicedPlanner()
+elif settings.PATHFINDING['PLANNER'] == 'replanning':
+    planner = Replanner()
+else:
+    planner = PathPlanner()
@@ -0,0 +1,88 @@
+"""Projectiles flying between the shooters and their targets
+"""
+import logging
+
+from .metrics import metrics
+
+
+class Projectile(object):
+
+    __slots__ = ('shooter', 'target', 'damage', 'remaining')
+
+    def __init__(self):
+        self.release()
+
+    def release(self):
+        self.shooter = None
+        self.target = None
+        self.damage = 0
+        self.remaining = 0.
+
+
+class ProjectileSystem(object):
+    """Every shot on its way, advanced by the simulation ticks instead of
+    a greenlet per bullet.
+
+    A projectile hits ``delay`` seconds after it was fired, all the hits
+    of a tick are resolved together by ``target.got_hit(shooter,
+    damage)``, the ones at targets dead meanwhile are dropped. Records
+    are reused, so bursts of shots don't allocate.
+    """
+
+    def __init__(self):
+        self.flying = []
+        self.free = []
+        self.shooters = {}
+
+    def fire(self, shooter, target, damage, delay):
+        try:
+            projectile = self.free.pop()
+        except IndexError:
+            projectile = Projectile()
+        projectile.shooter = shooter
+        projectile.target = target
+        projectile.damage = damage
+        projectile.remaining = delay
+        self.flying.append(projectile)
+        self.shooters[shooter] = self.shooters.get(shooter, 0) + 1
+        metrics.incr('projectiles.fired')
+        return projectile
+
+    def in_flight(self, shooter):
+        """Projectiles of ``shooter`` still on their way"""
+        return self.shooters.get(shooter, 0)
+
+    def update(self, dt):
+        flying = []
+        hits = []
+        for projectile in self.flying:
+            projectile.remaining -= dt
+            if projectile.remaining > 0:
+                flying.append(projectile)
+            else:
+                hits.append(projectile)
+        self.flying = flying
+        for projectile in hits:
+            self._resolve(projectile)
+        metrics.gauge('projectiles.flying', len(flying))
+
+    def _resolve(self, projectile):
+        shooter, target = projectile.shooter, projectile.target
+        count = self.shooters[shooter] - 1
+        if count:
+            self.shooters[shooter] = count
+        else:
+            del self.shooters[shooter]
+        try:
+            if not target.is_dead:
+                target.got_hit(shooter, projectile.damage)
+                metrics.incr('projectiles.hits')
+        except Exception:
+            logging.exception('Projectile of %s at %s failed',
+                              shooter, target)
+        finally:
+            projectile.release()
+            self.free.append(projectile)
+
+
+projectiles = ProjectileSystem()
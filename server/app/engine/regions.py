@@ -0,0 +1,160 @@
+"""Chunked world, the map simulated by regions only when players are near
+"""
+from __future__ import division
+
+import time
+
+from conf import settings
+from db import local_db
+
+from .metrics import metrics
+
+
+class Region(object):
+    """Square part of the map with the entities in it.
+
+    ``objects`` are the entities placed once, e.g. turrets, ``characters``
+    the ones found in it by the last ``World.update``. ``frozen`` is the
+    state of the objects taken once the region went to sleep, nothing
+    changes it until the region wakes up.
+    """
+
+    def __init__(self, key, bounds):
+        self.key = key
+        self.bounds = bounds
+        self.objects = []
+        self.characters = []
+        self.active = False
+        self.idle_since = None
+        self.frozen = None
+
+    def wake(self):
+        self.active = True
+        self.idle_since = None
+        self.frozen = None
+        metrics.incr('world.woken')
+
+    def sleep(self):
+        self.active = False
+        metrics.incr('world.slept')
+
+    def state(self):
+        """``{id: to_dict()}`` of the objects"""
+        if self.active:
+            return dict((obj.id, obj.to_dict()) for obj in self.objects)
+        if self.frozen is None:
+            self.frozen = dict((obj.id, obj.to_dict())
+                               for obj in self.objects)
+        return self.frozen
+
+
+class World(object):
+    """The map split into regions of ``size`` px, created when something
+    gets into them.
+
+    Regions with characters in them or next to them are active, the other
+    ones go to sleep ``sleep`` seconds after the last character left, so
+    the AI only runs where somebody can see it and the cost of a tick
+    follows the players instead of the area of the map.
+    """
+
+    def __init__(self, size=settings.GAME['REGION_SIZE'],
+                 sleep=settings.GAME['REGION_SLEEP']):
+        self.size = size
+        self.sleep = sleep
+        self.regions = {}
+        self.map_size = None
+
+    def ensure(self):
+        map_size = (local_db['map_size']['width'],
+                    local_db['map_size']['height'])
+        if map_size != self.map_size:
+            objects = [obj for region in self.regions.values()
+                       for obj in region.objects]
+            self.map_size = map_size
+            self.cols = max(1, -(-int(map_size[0]) // self.size))
+            self.rows = max(1, -(-int(map_size[1]) // self.size))
+            self.regions = {}
+            for obj in objects:
+                self.add(obj)
+        return self
+
+    def key_of(self, point):
+        """Region of ``point``, the ones off the map go to the closest"""
+        self.ensure()
+        return (min(max(int(point[0] // self.size), 0), self.cols - 1),
+                min(max(int(point[1] // self.size), 0), self.rows - 1))
+
+    def region(self, key):
+        try:
+            return self.regions[key]
+        except KeyError:
+            x0, y0 = key[0] * self.size, key[1] * self.size
+            region = self.regions[key] = Region(
+                key, (x0, y0, x0 + self.size, y0 + self.size))
+            return region
+
+    def add(self, obj):
+        """Place an entity which doesn't move, by its ``coords``"""
+        self.region(self.key_of(obj.coords)).objects.append(obj)
+
+    def remove(self, obj):
+        region = self.regions.get(self.key_of(obj.coords))
+        if region is not None and obj in region.objects:
+            region.objects.remove(obj)
+
+    def _around(self, key):
+        i, j = key
+        return [(ni, nj)
+                for ni in range(max(0, i - 1), min(self.cols, i + 2))
+                for nj in range(max(0, j - 1), min(self.rows, j + 2))]
+
+    def update(self, dt=None):
+        """Find the characters' regions, wake the regions they are in or
+        next to, and put to sleep the ones left alone for long enough.
+        """
+        self.ensure()
+        now = time.time()
+        for region in self.regions.values():
+            region.characters = []
+        near = set()
+        for char in local_db.get('characters', {}).values():
+            key = self.key_of(char.coords)
+            self.region(key).characters.append(char)
+            near.update(self._around(key))
+        for key in near:
+            region = self.region(key)
+            if not region.active:
+                region.wake()
+            region.idle_since = None
+        active = 0
+        for region in self.regions.values():
+            if not region.active:
+                continue
+            if region.key not in near:
+                if region.idle_since is None:
+                    region.idle_since = now
+                elif now - region.idle_since >= self.sleep:
+                    region.sleep()
+                    continue
+            active += 1
+        metrics.gauge('world.active', active)
+
+    def active(self):
+        return [region for region in self.regions.values() if region.active]
+
+    def objects(self):
+        """Objects of the active regions"""
+        return [obj for region in self.active() for obj in region.objects]
+
+    def state(self):
+        """``{id: to_dict()}`` of all the objects, the ones of the sleeping
+        regions as they were when they fell asleep.
+        """
+        state = {}
+        for region in self.regions.values():
+            state.update(region.state())
+        return state
+
+
+world = World()
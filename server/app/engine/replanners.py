@@ -0,0 +1,176 @@
+"""Incremental replanning (D* Lite) on the passability grid
+"""
+import heapq
+
+from .clusters import octile
+
+
+INF = float('inf')
+
+
+class DStarLite(object):
+    """D* Lite search of a path between two nodes of a grid.
+
+    The search runs backwards, from the goal, so when nodes get blocked
+    or free again only the part of the previous search they touch is
+    searched again, and the start may move on along the path meanwhile.
+    ``blocked`` are nodes closed on top of the grid, e.g. by bodies.
+
+    Moves are ``(di, dj, cost)`` tuples in node units.
+    """
+
+    def __init__(self, grid, start, goal, moves, blocked=(), limit=None):
+        self.grid = grid
+        self.start = start
+        self.goal = goal
+        self.moves = moves
+        self.blocked = set(blocked)
+        self.limit = limit
+        self.expanded = 0
+        # nodes of the search under way, it may span several ``compute``
+        self.searching = 0
+        self.km = 0.
+        self.g = {}
+        self.rhs = {goal: 0.}
+        self.queue = []
+        self.queued = {}
+        self._push(goal)
+
+    def _open(self, node):
+        i, j = node
+        grid = self.grid
+        return (0 <= i < grid.width and 0 <= j < grid.height and
+                grid.cells[j * grid.width + i] == 1 and
+                node not in self.blocked)
+
+    def _key(self, node):
+        cost = min(self.g.get(node, INF), self.rhs.get(node, INF))
+        return (cost + octile(self.start, node) + self.km, cost)
+
+    def _push(self, node):
+        key = self.queued[node] = self._key(node)
+        heapq.heappush(self.queue, (key, node))
+
+    def _successors(self, node):
+        """``(next, cost)`` of the moves from ``node``, it may be blocked
+        itself, e.g. the walker stands on the edge of an obstacle.
+        """
+        i, j = node
+        for di, dj, cost in self.moves:
+            nxt = (i + di, j + dj)
+            if self._open(nxt):
+                yield nxt, cost
+
+    def _predecessors(self, node):
+        """``(prev, cost)`` of the moves to ``node`` from the grid"""
+        i, j = node
+        width, height = self.grid.width, self.grid.height
+        return [((i - di, j - dj), cost) for di, dj, cost in self.moves
+                if 0 <= i - di < width and 0 <= j - dj < height]
+
+    def _requeue(self, node):
+        self.queued.pop(node, None)
+        if self.g.get(node, INF) != self.rhs.get(node, INF):
+            self._push(node)
+
+    def _update(self, node):
+        if node != self.goal:
+            self.rhs[node] = min([cost + self.g.get(nxt, INF)
+                                  for nxt, cost in self._successors(node)] or
+                                 [INF])
+        self._requeue(node)
+
+    def _top(self):
+        queue = self.queue
+        while queue:
+            key, node = queue[0]
+            if self.queued.get(node) == key:
+                return key, node
+            # stale entry, the node was queued again or left the queue
+            heapq.heappop(queue)
+        return (INF, INF), None
+
+    def compute(self, budget=None):
+        """Search until the start is consistent, ``False`` when it gave
+        up after ``limit`` nodes. With a ``budget`` it may stop after that
+        many nodes and return ``None``, the next call goes on from there.
+        """
+        start = self.start
+        g, rhs, goal = self.g, self.rhs, self.goal
+        expanded = 0
+        while True:
+            key, node = self._top()
+            if node is None:
+                break
+            if (key >= self._key(start) and
+                    rhs.get(start, INF) == g.get(start, INF)):
+                break
+            if (self.limit is not None and
+                    self.searching + expanded >= self.limit):
+                self.expanded += expanded
+                self.searching = 0
+                return False
+            if budget is not None and expanded >= budget:
+                self.expanded += expanded
+                self.searching += expanded
+                return None
+            expanded += 1
+            new_key = self._key(node)
+            if key < new_key:
+                self._push(node)
+                continue
+            heapq.heappop(self.queue)
+            del self.queued[node]
+            if g.get(node, INF) > rhs.get(node, INF):
+                cost_here = g[node] = rhs[node]
+                if not self._open(node):
+                    continue
+                for prev, cost in self._predecessors(node):
+                    if prev != goal and cost + cost_here < rhs.get(prev, INF):
+                        rhs[prev] = cost + cost_here
+                        self._requeue(prev)
+            else:
+                old = g.get(node, INF)
+                g[node] = INF
+                self._update(node)
+                for prev, cost in self._predecessors(node):
+                    if rhs.get(prev, INF) == cost + old:
+                        self._update(prev)
+        self.expanded += expanded
+        self.searching = 0
+        return True
+
+    def move_to(self, start):
+        """The walker got to ``start`` on the way"""
+        if start != self.start:
+            self.km += octile(self.start, start)
+            self.start = start
+
+    def set_blocked(self, blocked):
+        """Replace the extra blocked nodes, returns the changed ones"""
+        blocked = set(blocked)
+        changed = blocked ^ self.blocked
+        self.blocked = blocked
+        for node in changed:
+            # only the moves onto the node cost something else now
+            for prev, _ in self._predecessors(node):
+                self._update(prev)
+        return changed
+
+    def path(self):
+        """Nodes from the start to the goal, empty when there is no way"""
+        if self.compute() is False or self.g.get(self.start, INF) == INF:
+            return []
+        path = [self.start]
+        seen = set(path)
+        while path[-1] != self.goal:
+            successors = list(self._successors(path[-1]))
+            if not successors:
+                return []
+            nxt = min(successors,
+                      key=lambda s: s[1] + self.g.get(s[0], INF))[0]
+            if nxt in seen:
+                return []
+            seen.add(nxt)
+            path.append(nxt)
+        return path
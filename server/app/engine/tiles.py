@@ -1,25 +1,28 @@
-import pytmx
+from db import local_db
 
 from .colliders import spatial_hash
+from .grids import passability
+from .maps import load_map
 
 
 class TiledReader(object):
 
     @classmethod
     def read_and_add_collision(cls, fname):
-        tiled_map = pytmx.TiledMap(fname)
-        collision_layers = (layer for layer in tiled_map.layers
-                            if isinstance(layer, pytmx.TiledObjectGroup))
-        for layer in collision_layers:
-            for obj in layer:
-                box = cls._get_obj_box(obj)
-                spatial_hash.insert_object_for_box(box, obj)
-
-        print(spatial_hash.contents)
-
-    @staticmethod
-    def _get_obj_box(obj):
-        return {
-            'min': (obj.x, obj.y),
-            'max': (obj.x + obj.width, obj.y + obj.height)
+        """Take the collisions, size and spawn points of the map from its
+        compiled artifact, the TMX is only parsed when it changed. The
+        collision objects go to ``spatial_hash`` by their boxes.
+        """
+        compiled = load_map(fname)
+        local_db['map_size'] = {
+            'width': compiled.map_width,
+            'height': compiled.map_height
         }
+        local_db['spawns'] = compiled.spawns
+        if passability.compiled is not None:
+            for obj in passability.compiled.objects:
+                spatial_hash.remove_obj_by_box(obj.box, obj)
+        for obj in compiled.objects:
+            spatial_hash.insert_object_for_box(obj.box, obj)
+        passability.use_map(compiled)
+        return compiled
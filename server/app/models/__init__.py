@@ -1,3 +1,4 @@
 from .users import UserModel
 from .characters import CharacterModel, Outlander
 from .ai import Turret
+from .persistence import write_behind
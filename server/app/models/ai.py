@@ -1,10 +1,7 @@
-import math
-import gevent
-from gevent.queue import Queue
-
-
 import constants as const
 from db import local_db
+from ..engine import bodies_hash, index_bodies, projectiles, world
+from .cooldowns import Cooldowns
 from .weapons import Weapon
 
 
@@ -21,17 +18,12 @@ class Turret(object):
         self.x = x
         self.y = y
         self.current_target = None
-        self._total_counter = 0
-        self._queue = Queue()
-
-        gevent.spawn(self.start)
+        self.cooldowns = Cooldowns()
+        world.add(self)
 
-    def start(self):
-        while True:
-            cmd = self._queue.get()
-            method, args = cmd['method'], cmd['args']
-            method(*args)
-            self._total_counter -= 1
+    @property
+    def coords(self):
+        return (self.x, self.y)
 
     def to_dict(self):
         return {
@@ -46,43 +38,62 @@ class Turret(object):
     def get_all(cls):
         return [turret.to_dict() for turret in local_db['turrets']]
 
-    def _multiply_vector(self, coords):
-        return math.sqrt((coords[0] - self.x) ** 2 + (coords[1] - self.y) ** 2)
+    @classmethod
+    def update_all(cls, dt=None):
+        """AI phase of the simulation tick: target acquisition for the
+        turrets of the active regions against a single index of the
+        characters.
+        """
+        index_bodies(local_db['characters'].values())
+        turrets = [obj for obj in world.objects() if isinstance(obj, cls)]
+        # the cells around all the turrets in one pass, only the ones with
+        # somebody near look for the nearest
+        near = bodies_hash.batch_query([turret._range_box()
+                                        for turret in turrets])
+        for turret, ids in zip(turrets, near):
+            if ids:
+                turret.detect_target()
+            else:
+                turret.current_target = None
+
+    def _range_box(self):
+        r = self.weapon.w.RANGE
+        return {'min': (self.x - r, self.y - r),
+                'max': (self.x + r, self.y + r)}
+
+    def _distance_sq(self, target):
+        return (target.x - self.x) ** 2 + (target.y - self.y) ** 2
 
     def in_range(self, target):
-        return bool((target.x - self.x) ** 2 + (target.y - self.y) ** 2 <=
-                    self.weapon.w.RANGE ** 2)
-
-    def detect_target(self, targets):
-        targets = filter(self.in_range, targets)
-        new_target = None
-        for target in targets:
-            if target and (
-                target.is_dead or target.display == const.Display.Hidden
-            ):
-                continue
-            if not new_target or (
-                self._multiply_vector((new_target.x,
-                                       new_target.y)) >
-                self._multiply_vector((target.x, target.y))
-            ):
-                new_target = target
-        if new_target:
-            self.current_target = new_target
-            if self._total_counter < 2:
+        return bool(self._distance_sq(target) <= self.weapon.w.RANGE ** 2)
+
+    @staticmethod
+    def _targetable(target):
+        return not (target.is_dead or
+                    target.display == const.Display.Hidden)
+
+    def detect_target(self):
+        found = bodies_hash.nearest((self.x, self.y), 1, self._targetable,
+                                    self.weapon.w.RANGE)
+        if found:
+            self.current_target = found[0][0]
+            # one shot at a time, the next goes when it hits and the gun
+            # has cooled down
+            if not (self.operations_blocked or projectiles.in_flight(self)):
                 self.shoot()
-                self._total_counter += 1
         else:
             self.current_target = None
 
+    @property
+    def operations_blocked(self):
+        return self.cooldowns.blocked()
+
     def shoot(self):
         if not self.current_target or self.current_target.is_dead:
             return
 
-        self._queue.put({
-            'method': self.weapon.shoot,
-            'args': (self.current_target,)
-        })
+        self.cooldowns.start('shoot', self.weapon.w.SHOOT_TIME)
+        self.weapon.shoot(self.current_target)
 
     def update(self):
         pass
@@ -6,28 +6,24 @@ import random
 import json
 import time
 
-import gevent
 from gevent.pool import Pool
 
-from utils import lookahead
-from db import redis_db, local_db
+from conf import settings
+from db import redis_db
 import constants as const
 from .commands import CmdModel, field_extractor
+from ..cooldowns import Cooldowns
+from ..persistence import write_behind
 from ..weapons import Weapon
 from ..armors import Armor
-from ...engine import Pathfinder, CollisionManager
+from ...engine import CollisionManager, bodies_hash, movement, planner
 
 
 def autosave(func):
     def wrapper(self, *args, **kwargs):
         # with self.cm.obj_update():
-        logging.info('GREENLETS: %s' % self.AP_stats)
         result = func(self, *args, **kwargs)
-        self.cmd = CmdModel.create(self.id, self.cmd.x, self.cmd.y,
-                                   self.cmd.action, self.cmd.direction)
-        self.save()
-        for turret in local_db['turrets']:
-            turret.detect_target(local_db['characters'].values())
+        self.mark_dirty()
         return result
     return wrapper
 
@@ -44,7 +40,6 @@ class CharacterModel(object):
         'user_collision',
     )
 
-    AP_stats = {}
     allowed_actions = set(['shoot', 'move', 'heal', 'equip'])
 
     def __init__(self, id, user_id, race, name, health, weapon, armor, scores,
@@ -58,16 +53,18 @@ class CharacterModel(object):
         self.armor = Armor(armor, self)
         self.scores = scores
         self.inventory = inventory
-        self.AP = const.MAX_AP
         self.max_AP = const.MAX_AP
+        self._AP = const.MAX_AP
+        self._AP_since = time.time()
 
         self._pool = Pool(self.max_pool_size)
-        self.operations = []
+        self.cooldowns = Cooldowns(on_expire=self._cooldown_expired)
         self.steps = []
         self.extra_data = {}
         self.max_health = self.setup_params['health']
         self._footpace = [2, 2]
         self.display = const.Display(display)
+        self._persisted = None
 
         if self.id:
             self.cmd = CmdModel.get_last_or_create(self.id)
@@ -75,8 +72,6 @@ class CharacterModel(object):
             #                            pipelines=self.collision_pipeline)
             # self.pf = Pathfinder(2, 32, 3, 2, [])
 
-        self._pool.spawn(self.restore_AP)
-
     def is_allowed(self, fname):
         return bool(fname in self.allowed_actions)
 
@@ -88,11 +83,32 @@ class CharacterModel(object):
         if not self.id:
             self.id = redis_db.incr('%s:ids' % self.model_key())
 
-        data = json.dumps(field_extractor(self))
+        data = self._persisted = json.dumps(field_extractor(self))
         return redis_db.hset(self.model_key(), self.id, data)
 
+    def mark_dirty(self):
+        """Schedule the write for the next ``write_behind`` flush"""
+        write_behind.mark(self)
+        cmd = getattr(self, 'cmd', None)
+        if cmd is not None:
+            cmd.mark_dirty()
+
+    def persist(self, pipe):
+        if not self.id:
+            return
+        data = json.dumps(field_extractor(self))
+        if data == self._persisted:
+            return
+        pipe.hset(self.model_key(), self.id, data)
+
+        def _written():
+            self._persisted = data
+        return _written
+
     @classmethod
     def get(cls, id):
+        # read our own pending writes
+        write_behind.flush()
         data = redis_db.hget(cls.model_key(), id)
         if data:
             return cls(**json.loads(data))
@@ -135,15 +151,18 @@ class CharacterModel(object):
             'weapon': self.weapon.name.value,
             'health': self.health,
             'operations_blocked': self.operations_blocked,
+            'planning': self.is_planning,
             'animation': self.animation,
-            'extra_data': self.extra_data,
+            # copies, the recorded snapshots must not change along with
+            # the character
+            'extra_data': dict(self.extra_data),
             'updated_at': time.time(),
             'scores': self.scores,
             'max_health': self.max_health,
-            'operations': self.operations,
+            'cooldowns': self.cooldowns.to_dict(),
             'AP': self.AP,
             'max_AP': self.max_AP,
-            'steps': self.steps,
+            'steps': list(self.steps),
             'weapon_range': self.weapon.w.RANGE
         }
 
@@ -202,10 +221,22 @@ class CharacterModel(object):
         return bool(self.health <= 0)
 
     def block_operation(self, type):
-        self.operations.append({
-            'type': type,
-            'blocked_at': time.time()
-        })
+        now = time.time()
+        self._materialize_AP(now)
+        expires_at = self.cooldowns.start(type, self._block_time(type),
+                                          now=now)
+        # AP is not restored while operations are blocked
+        self._AP_since = max(self._AP_since, expires_at)
+
+    def _block_time(self, type):
+        if type == 'shoot':
+            return self.weapon.w.SHOOT_TIME
+        elif type == 'heal':
+            return const.HEAL_TIME
+        return 0
+
+    def _cooldown_expired(self, type):
+        self.extra_data['sound_to_play'] = None
 
     @property
     def coords(self):
@@ -231,28 +262,14 @@ class CharacterModel(object):
     def is_full_health(self):
         return self.health == const.HUMAN_HEALTH
 
+    @property
+    def is_planning(self):
+        """The path of the last move is still being searched"""
+        return planner.is_planning(self.id)
+
     @property
     def operations_blocked(self):
-        try:
-            if self.is_dead:
-                return True
-
-            ct = time.time()
-
-            for i, operation in enumerate(self.operations[:]):
-                if operation['type'] == 'shoot':
-                    block_for = self.weapon.w.SHOOT_TIME
-                elif operation['type'] == 'heal':
-                    block_for = const.HEAL_TIME
-                if ct - operation['blocked_at'] <= block_for:
-                    return True
-                else:
-                    del self.operations[i]
-                    self.extra_data['sound_to_play'] = None
-        except KeyError:
-            return False
-        else:
-            return False
+        return self.is_dead or self.cooldowns.blocked()
 
     def _delayed_command(self, delay, fname, *args, **kwargs):
 
@@ -290,6 +307,14 @@ class CharacterModel(object):
     def stealth(self):
         raise NotImplementedError()
 
+    @property
+    def vision_range(self):
+        """Range of the best weapon the character can take in hands, it
+        doesn't shrink when the weapon is put away.
+        """
+        return max(self.weapon.w.RANGE,
+                   Weapon.kind(self.setup_params['weapon']).RANGE)
+
     @property
     def weapon_in_hands(self):
         return self.weapon.name != const.Weapon.Unarmed
@@ -305,30 +330,36 @@ class CharacterModel(object):
         elif type == 'weapon':
             self.weapon = Weapon(self.setup_params['weapon'], self)
 
-    def use_AP(self, p):
-        self.AP -= p
-        if self.AP < 0:
-            self.AP = 0
-
-    def restore_AP(self):
-        while True:
-            if self.AP < self.max_AP and not self.operations_blocked:
-                self.incr_AP()
-            gevent.sleep(1)
-
-    def _kill_AP_threads(self):
-        self.AP_stats.setdefault(self.id, [])
-        if self.AP_stats.get(self.id):
-            gevent.killall(self.AP_stats[self.id])
-            self.AP_stats[self.id] = []
-
-    @autosave
-    def incr_AP(self):
-        self.AP += 1
-        if self.AP > const.MAX_AP:
-            self.AP = const.MAX_AP
+    @property
+    def AP(self):
+        self._materialize_AP()
+        return self._AP
+
+    @AP.setter
+    def AP(self, value):
+        self._AP = value
+        self._AP_since = time.time()
+
+    def _materialize_AP(self, now=None):
+        """Add the AP restored since ``_AP_since``, one per
+        ``AP_RESTORE_TIME`` seconds, instead of a greenlet ticking them.
+        """
+        if self._AP >= self.max_AP or self.is_dead:
+            return
+        if now is None:
+            now = time.time()
+        restored = int((now - self._AP_since) // const.AP_RESTORE_TIME)
+        if restored > 0:
+            self._AP = min(self.max_AP, self._AP + restored)
+            self._AP_since += restored * const.AP_RESTORE_TIME
 
-        logging.info("ID: %s - AP: %s" % (self.id, self.AP))
+    def use_AP(self, p):
+        now = time.time()
+        self._materialize_AP(now)
+        if self._AP >= self.max_AP:
+            # restoring starts from the first spent point
+            self._AP_since = max(self._AP_since, now)
+        self._AP = max(0, self._AP - p)
 
     @autosave
     def got_hit(self, shooter, dmg):
@@ -354,13 +385,18 @@ class CharacterModel(object):
         else:
             self.display_hide()
 
+    def in_heal_range(self, other):
+        return any(obj is other for obj, _ in bodies_hash.query_radius(
+            self.coords, const.HEAL_RANGE, exclude=self))
+
     @autosave
     def heal(self, target=None):
         if all([
             not self.is_full_health,
             not self.operations_blocked,
             self.AP - const.HEAL_AP >= 0,
-            self.is_allowed('heal')
+            self.is_allowed('heal'),
+            not target or target == self or self.in_heal_range(target)
         ]):
             self.display_show()
             self.cmd.action = const.Action.Heal
@@ -374,7 +410,7 @@ class CharacterModel(object):
                 logging.info('Health before heal: %s', target.health)
                 if target.health > target.max_health:
                     target.health = target.max_health
-                target.save()
+                target.mark_dirty()
 
             if target and target != self:
                 target = target
@@ -419,54 +455,33 @@ class CharacterModel(object):
         except KeyError:
             pass
 
-    PATH_TREADS = {}
-
     def _kill_path(self):
-        try:
-            self.PATH_TREADS[self.id].kill()
-            del self.PATH_TREADS[self.id]
-        except Exception:
-            pass
-        finally:
-            self.steps = []
+        planner.cancel(self.id)
+        movement.remove(self.id)
+        self.steps = []
 
     def _clear_greenlets(self):
-        self._kill_AP_threads()
         self._kill_path()
 
+    # counterclockwise from the east, by 45 degrees, y goes down
+    octant_directions = (
+        const.Direction.E, const.Direction.SE, const.Direction.S,
+        const.Direction.SW, const.Direction.W, const.Direction.NW,
+        const.Direction.N, const.Direction.NE,
+    )
+
     def detect_direction_and_speed(self, init, next, speed=0.015):
-        if init[0] - next[0] != 0 and init[1] - next[1] != 0:
-            logging.debug('UID: %s, define GO', self.id)
-            if next[0] > init[0] and next[1] < init[1]:
-                logging.debug('UID: %s, GO UP-RIGHT', self.id)
-                direction = const.Direction.NE
-            elif next[0] > init[0] and next[1] > init[1]:
-                logging.debug('UID: %s, GO BOTTOM-RIGHT', self.id)
-                direction = const.Direction.SE
-            elif next[0] < init[0] and next[1] > init[1]:
-                logging.debug('UID: %s, GO BOTTOM-LEFT', self.id)
-                direction = const.Direction.SW
-            elif next[0] < init[0] and next[1] < init[1]:
-                logging.debug('UID: %s, GO UP-LEFT', self.id)
-                direction = const.Direction.NW
-            speed *= math.sqrt(2)
-        elif init[0] - next[0] == 0:
-            logging.debug('UID: %s, GO Y', self.id)
-            if next[1] - init[1] >= 0:
-                logging.debug('UID: %s, GO BOTTOM', self.id)
-                direction = const.Direction.S
-            else:
-                logging.debug('UID: %s, GO TOP', self.id)
-                direction = const.Direction.N
-        elif init[1] - next[1] == 0:
-            logging.debug('UID: %s, GO X', self.id)
-            if next[0] - init[0] >= 0:
-                logging.debug('UID: %s, GO RIGHT', self.id)
-                direction = const.Direction.E
-            else:
-                logging.debug('UID: %s, GO LEFT', self.id)
-                direction = const.Direction.W
-        return direction, speed
+        """Direction closest to the one from ``init`` to ``next`` and
+        the seconds it takes to walk there, ``speed`` per footpace.
+        """
+        dx = next[0] - init[0]
+        dy = next[1] - init[1]
+        if not dx and not dy:
+            return const.Direction.S, 0.
+        octant = int(round(math.atan2(dy, dx) / (math.pi / 4))) % 8
+        direction = self.octant_directions[octant]
+        logging.debug('UID: %s, GO %s', self.id, direction.name)
+        return direction, speed * math.hypot(dx, dy) / self._footpace[0]
 
     @autosave
     def move(self, point):
@@ -475,24 +490,17 @@ class CharacterModel(object):
         self.stop()
 
         # path = self.pf.search(self.coords, point)
-        pf = Pathfinder.build_path(self, point, 'A*')
-
-        def _move(pf):
-            for i, lk in enumerate(lookahead(reversed(list(pf)))):
-                step, has_more = lk
-                if i == 0:
-                    prev_step = step
-
-                direction, speed = self.detect_direction_and_speed(prev_step,
-                                                                   step)
-                prev_step = step
+        planner.request(self, point, self._follow_path,
+                        settings.PATHFINDING['ALGORITHM'])
 
-                self._plot_path(const.Action.Walk, direction, step)
-                gevent.sleep(speed)
-                if not has_more:
-                    self._delayed_command(0, 'stop')
+    def _follow_path(self, path):
+        movement.add(self, reversed(path))
 
-        self.PATH_TREADS[self.id] = self._pool.spawn(_move, pf)
+    def _walk_steps(self, direction, steps):
+        """Waypoints passed by the character during a simulation tick and
+        the point it is at now.
+        """
+        self._plot_path(const.Action.Walk, direction, steps[-1], steps[:-1])
 
     @autosave
     def stop(self):
@@ -500,7 +508,7 @@ class CharacterModel(object):
         self._plot_path(const.Action.Breathe, self.cmd.direction, self.coords)
 
     @autosave
-    def _plot_path(self, action, direction, coords):
+    def _plot_path(self, action, direction, coords, passed=()):
         if self.operations_blocked or self.is_dead:
             return
         logging.info('Current coords: %s', self.coords)
@@ -520,4 +528,5 @@ class CharacterModel(object):
             self.cmd.x = coords[0]
             self.cmd.y = coords[1]
 
+        self.steps.extend(passed)
         self.steps.append(self.coords)
@@ -1,4 +1,5 @@
 import json
+import random
 from enum import IntEnum, Enum
 
 from ..weapons import Weapon
@@ -8,6 +9,7 @@ from conf import settings
 from db import redis_db, local_db
 import constants as const
 from utils import getIsoX, getIsoY
+from ..persistence import write_behind
 
 
 def field_extractor(inst):
@@ -26,6 +28,10 @@ class CmdModel(object):
 
     fields = ('id', 'x', 'y', 'action', 'direction')
 
+    # ids are reserved from redis in blocks, not with an INCR per command
+    ID_BLOCK = 100
+    _ids = iter(())
+
     def __init__(self, id, character_id, x, y, action, direction):
         self.id = id
         self.character_id = int(character_id)
@@ -34,10 +40,24 @@ class CmdModel(object):
         # self.setIsoCoords((x, y))
         self.action = const.Action(action)
         self.direction = const.Direction(direction)
+        self._persisted = self.state if id else None
 
     def __repr__(self):
         return '<CmdModel: id - %s>' % self.id
 
+    @property
+    def state(self):
+        return (self.x, self.y, self.action, self.direction)
+
+    @classmethod
+    def next_id(cls):
+        try:
+            return next(CmdModel._ids)
+        except StopIteration:
+            last = redis_db.incrby('cmds:ids', cls.ID_BLOCK)
+            CmdModel._ids = iter(range(last - cls.ID_BLOCK + 1, last + 1))
+            return next(CmdModel._ids)
+
     @property
     def isoX(self):
         return local_db['map_size']['width'] / 2 + getIsoX((self.x, self.y))
@@ -71,9 +91,25 @@ class CmdModel(object):
 
     def save(self):
         if not self.id:
-            self.id = redis_db.incr('cmds:ids')
+            self.id = self.next_id()
+        self._persisted = self.state
         return redis_db.rpush('cmds:%s' % self.character_id, self.to_json())
 
+    def mark_dirty(self):
+        write_behind.mark(self)
+
+    def persist(self, pipe):
+        state = self.state
+        if state == self._persisted:
+            return
+        # every persisted state is a new entry of the command log
+        self.id = self.next_id()
+        pipe.rpush('cmds:%s' % self.character_id, self.to_json())
+
+        def _written():
+            self._persisted = state
+        return _written
+
     @classmethod
     def last(cls, character_id):
         try:
@@ -95,5 +131,10 @@ class CmdModel(object):
             raise TypeError("Can't be None")
         cmd = CmdModel.last(character_id)
         if not cmd:
-            cmd = CmdModel.create(character_id)
+            spawns = local_db.get('spawns')
+            if spawns:
+                x, y = random.choice(spawns)
+                cmd = CmdModel.create(character_id, x, y)
+            else:
+                cmd = CmdModel.create(character_id)
         return cmd
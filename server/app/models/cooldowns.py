@@ -0,0 +1,73 @@
+import time
+import heapq
+
+
+class Cooldowns(object):
+    """Expiry timestamps keyed by operation type.
+
+    Blocking cooldowns (shoot, heal) block every operation of the owner
+    while active, non blocking ones are plain timers for buffs and effects.
+    Expired entries are popped from a heap ordered by expiry, so checks
+    never scan the whole table.
+    """
+
+    def __init__(self, on_expire=None):
+        self.on_expire = on_expire
+        self._expiry = {}
+        self._heap = []
+        self._blocked_until = 0.
+
+    def start(self, type, duration, blocking=True, now=None):
+        if now is None:
+            now = time.time()
+        expires_at = now + duration
+        self._expiry[type] = (expires_at, blocking)
+        heapq.heappush(self._heap, (expires_at, type))
+        if blocking:
+            self._blocked_until = max(self._blocked_until, expires_at)
+        return expires_at
+
+    def _expire(self, now):
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            expires_at, type = heapq.heappop(heap)
+            # the entry may have been restarted with a later expiry
+            if self._expiry.get(type, (None,))[0] != expires_at:
+                continue
+            del self._expiry[type]
+            if callable(self.on_expire):
+                self.on_expire(type)
+
+    def blocked(self, now=None):
+        if now is None:
+            now = time.time()
+        self._expire(now)
+        return now <= self._blocked_until
+
+    def is_active(self, type, now=None):
+        if now is None:
+            now = time.time()
+        self._expire(now)
+        return type in self._expiry
+
+    def remaining(self, type, now=None):
+        if now is None:
+            now = time.time()
+        try:
+            return max(0., self._expiry[type][0] - now)
+        except KeyError:
+            return 0.
+
+    def clear(self):
+        self._expiry = {}
+        self._heap = []
+        self._blocked_until = 0.
+
+    def to_dict(self, now=None):
+        if now is None:
+            now = time.time()
+        self._expire(now)
+        return {
+            type: round(max(0., expires_at - now), 1)
+            for type, (expires_at, _) in self._expiry.items()
+        }
@@ -0,0 +1,54 @@
+"""Write-behind storage of the models
+"""
+import logging
+from collections import OrderedDict
+
+from db import redis_db
+
+
+class WriteBehind(object):
+    """Collects dirty models and writes them with one pipelined round
+    trip per flush instead of one per change.
+
+    Models implement ``persist(pipe)``, which queues their pending changes
+    on the pipeline and returns a callback to run once they are written, or
+    ``None`` when there is nothing to write.
+    """
+
+    def __init__(self, db=redis_db):
+        self.db = db
+        self._dirty = OrderedDict()
+
+    def mark(self, model):
+        self._dirty[id(model)] = model
+
+    @property
+    def pending(self):
+        return len(self._dirty)
+
+    def flush(self, dt=None):
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, OrderedDict()
+        pipe = self.db.pipeline(transaction=False)
+        written = []
+        for model in dirty.values():
+            callback = model.persist(pipe)
+            if callback is not None:
+                written.append(callback)
+        if written:
+            try:
+                pipe.execute()
+            except Exception:
+                # keep them for the next flush
+                for key, model in dirty.items():
+                    self._dirty.setdefault(key, model)
+                raise
+            for callback in written:
+                callback()
+        logging.debug('Flushed %s of %s dirty models',
+                      len(written), len(dirty))
+        return len(written)
+
+
+write_behind = WriteBehind()
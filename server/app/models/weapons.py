@@ -1,6 +1,7 @@
 import random
 
 import constants as const
+from ..engine import bodies_hash, projectiles
 
 
 class WeaponVision(object):
@@ -13,26 +14,29 @@ class WeaponVision(object):
         return self.in_range(other)
 
     def in_range(self, other):
-        return bool((other.x - self.user.x) ** 2 +
-                    (other.y - self.user.y) ** 2 <=
-                    self.weapon.w.RANGE ** 2)
+        return any(obj is other for obj, _ in bodies_hash.query_radius(
+            (self.user.x, self.user.y), self.weapon.w.RANGE,
+            exclude=self.user))
 
 
 class Weapon(object):
 
     def __init__(self, name, user):
-        _weapons = {
-            const.Weapon.Unarmed: Unarmed,
-            const.Weapon.Heavy: Heavy,
-            const.Weapon.Rifle: Rifle,
-            const.Weapon.TurretGun: TurretGun
-        }
         self.name = name
-        self.w = _weapons[const.Weapon(name)]()
+        self.w = self.kind(name)()
         self.w.user = user
         self.user = user
         self._vision = WeaponVision(self)
 
+    @staticmethod
+    def kind(name):
+        return {
+            const.Weapon.Unarmed: Unarmed,
+            const.Weapon.Heavy: Heavy,
+            const.Weapon.Rifle: Rifle,
+            const.Weapon.TurretGun: TurretGun
+        }[const.Weapon(name)]
+
     def in_vision(self, other):
         return self._vision.in_vision(other)
 
@@ -54,9 +58,7 @@ class BaseWeapon(object):
         if not self.DELAY:
             detected.got_hit(self.user, calc_damage)
         else:
-            detected._delayed_command(self.DELAY,
-                                      'got_hit', self.user,
-                                      calc_damage).get()
+            projectiles.fire(self.user, detected, calc_damage, self.DELAY)
 
 
 class Unarmed(BaseWeapon):
@@ -0,0 +1,3 @@
+from .channels import ClientChannel
+from .interest import ClientInterest, InterestIndex
+from .snapshots import SnapshotHistory
@@ -0,0 +1,68 @@
+"""Outbound websocket delivery
+"""
+import logging
+from collections import deque
+
+import gevent
+from gevent.event import Event
+from geventwebsocket import WebSocketError
+
+
+class ClientChannel(object):
+    """Own writer greenlet per websocket, so a slow ``ws.send`` only
+    delays its own client and never the ticker.
+
+    Regular messages are delivered in order. World frames are conflated:
+    only the newest pending frame is kept, an older unsent one is dropped.
+    """
+
+    def __init__(self, ws, on_error=None):
+        self.ws = ws
+        self.on_error = on_error
+        self.dropped_frames = 0
+        self.closed = False
+        self._messages = deque()
+        self._frame = None
+        self._ready = Event()
+        self._writer = gevent.spawn(self._write_loop)
+
+    def push(self, message):
+        if self.closed:
+            return
+        self._messages.append(message)
+        self._ready.set()
+
+    def push_frame(self, frame):
+        if self.closed:
+            return
+        if self._frame is not None:
+            self.dropped_frames += 1
+        self._frame = frame
+        self._ready.set()
+
+    def _write_loop(self):
+        try:
+            while True:
+                self._ready.wait()
+                self._ready.clear()
+                while self._messages:
+                    self.ws.send(self._messages.popleft())
+                frame, self._frame = self._frame, None
+                if frame is not None:
+                    self.ws.send(frame)
+        except WebSocketError as e:
+            logging.error(e)
+            if not self.closed:
+                self._discard()
+                if callable(self.on_error):
+                    self.on_error()
+
+    def _discard(self):
+        self.closed = True
+        self._messages.clear()
+        self._frame = None
+
+    def close(self):
+        self._discard()
+        if gevent.getcurrent() is not self._writer:
+            self._writer.kill(block=False)
@@ -0,0 +1,73 @@
+"""Area of interest management
+"""
+from __future__ import division
+
+from collections import OrderedDict
+
+from conf import settings
+from ..engine.colliders import UniformGrid
+
+
+class InterestIndex(object):
+    """Spatial index over the entities of a world state.
+
+    Rebuilt once per tick, then queried for every client, so a client only
+    costs the entities around it instead of the whole world.
+    """
+
+    def __init__(self, cell_size=settings.NETWORK['AOI_CELL_SIZE']):
+        self.hash = UniformGrid(cell_size)
+        self._points = {}
+
+    def rebuild(self, state):
+        self.hash.ensure().clear()
+        self._points = {}
+        for section, entities in state.items():
+            for eid, entity in entities.items():
+                key = (section, eid)
+                point = (entity['x'], entity['y'])
+                self._points[key] = point
+                self.hash.insert_object_for_point(point, key)
+
+    def query(self, center, radius):
+        cx, cy = center
+        box = {
+            'min': (cx - radius, cy - radius),
+            'max': (cx + radius, cy + radius)
+        }
+        r2 = radius ** 2
+        points = self._points
+        return frozenset(
+            key for key in self.hash.pottential_collisions(box, None)
+            if (points[key][0] - cx) ** 2 + (points[key][1] - cy) ** 2 <= r2
+        )
+
+
+class ClientInterest(object):
+    """What a single client sees, remembered per snapshot sequence so
+    deltas can be built against the view it acknowledged.
+    """
+
+    def __init__(self, size=settings.NETWORK['SNAPSHOT_HISTORY']):
+        self.size = size
+        self.visible = None
+        self._views = OrderedDict()
+
+    @staticmethod
+    def radius(char):
+        radius = settings.NETWORK['AOI_RADIUS']
+        if radius is None:
+            radius = char.vision_range + settings.NETWORK['AOI_MARGIN']
+        return radius
+
+    def observe(self, seq, visible):
+        """Store the new view and return ``(entered, left)`` keys"""
+        prev = self.visible if self.visible is not None else frozenset()
+        self.visible = visible
+        self._views[seq] = visible
+        while len(self._views) > self.size:
+            self._views.popitem(last=False)
+        return visible - prev, prev - visible
+
+    def at(self, seq):
+        return self._views.get(seq)
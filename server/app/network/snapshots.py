@@ -0,0 +1,124 @@
+"""Sequenced world snapshots and deltas against acknowledged baselines
+"""
+from collections import OrderedDict
+
+from conf import settings
+
+
+# fields that change on every tick and are only worth sending along with
+# a real change of the entity
+VOLATILE_FIELDS = ('updated_at',)
+
+
+def entity_delta(old, new):
+    changed = {}
+    for key, value in new.items():
+        if key in VOLATILE_FIELDS:
+            continue
+        if key not in old or old[key] != value:
+            changed[key] = value
+    if changed:
+        for key in VOLATILE_FIELDS:
+            if key in new:
+                changed[key] = new[key]
+        changed['id'] = new['id']
+    return changed
+
+
+def state_keys(state):
+    return frozenset((section, eid)
+                     for section, entities in state.items()
+                     for eid in entities)
+
+
+class SnapshotHistory(object):
+    """Keeps the last ``size`` world states by sequence number.
+
+    A world state is ``{section: {entity_id: entity_dict}}``. Clients
+    acknowledge the sequence they applied and get the next snapshot as a
+    delta against it; unknown or too old baselines get a full snapshot.
+
+    A client may see only part of the world: ``visible`` and
+    ``base_visible`` are sets of ``(section, entity_id)`` keys it gets now
+    and had at the baseline. Entities entering or leaving its view come as
+    ``add`` and ``remove`` entries.
+    """
+
+    def __init__(self, size=settings.NETWORK['SNAPSHOT_HISTORY']):
+        self.size = size
+        self.seq = 0
+        self._states = OrderedDict()
+        self._keys = {}
+        self._snapshots = {}
+        self._deltas = {}
+
+    def record(self, state):
+        self.seq += 1
+        self._states[self.seq] = state
+        self._keys[self.seq] = state_keys(state)
+        while len(self._states) > self.size:
+            seq, _ = self._states.popitem(last=False)
+            del self._keys[seq]
+        self._snapshots = {}
+        self._deltas = {}
+        return self.seq
+
+    @property
+    def state(self):
+        return self._states[self.seq]
+
+    def has(self, seq):
+        return seq in self._states
+
+    def baseline(self, acked_seq):
+        """Sequence usable as delta baseline, ``None`` means full"""
+        return acked_seq if self.has(acked_seq) else None
+
+    def _entity_delta(self, base_seq, key):
+        # the same entity delta is shared by every client on this baseline
+        try:
+            return self._deltas[base_seq, key]
+        except KeyError:
+            section, eid = key
+            delta = self._deltas[base_seq, key] = entity_delta(
+                self._states[base_seq][section][eid], self.state[section][eid])
+            return delta
+
+    def snapshot(self, base_seq=None, visible=None, base_visible=None):
+        """Snapshot of the latest state, cached for the tick"""
+        cache_key = (base_seq, visible, base_visible)
+        try:
+            return self._snapshots[cache_key]
+        except KeyError:
+            pass
+        state = self.state
+        if visible is None:
+            visible = self._keys[self.seq]
+        full = base_seq is None or not self.has(base_seq)
+        data = {'seq': self.seq, 'base': None if full else base_seq,
+                'full': full}
+        for section in state:
+            data[section] = {'add': [], 'update': [], 'remove': []}
+
+        if full:
+            for section, eid in visible:
+                data[section]['add'].append(state[section][eid])
+        else:
+            if base_visible is None:
+                base_visible = self._keys[base_seq]
+            for key in visible:
+                section, eid = key
+                if key not in base_visible:
+                    data[section]['add'].append(state[section][eid])
+                else:
+                    delta = self._entity_delta(base_seq, key)
+                    if delta:
+                        data[section]['update'].append(delta)
+            for key in base_visible:
+                if key not in visible:
+                    section, eid = key
+                    data.setdefault(section, {
+                        'add': [], 'update': [], 'remove': []
+                    })['remove'].append(eid)
+        self._snapshots[cache_key] = data
+        return data
@@ -4,12 +4,14 @@ HEAL_TIME = 1
 RESURECTION_TIME = 5
 HUMAN_HEALTH = 100
 MAX_AP = 10
+AP_RESTORE_TIME = 1
 
 HEAL_AP = 4
 FIRE_AP = 5
 STEALTH_AP = 3
 
 HEAL_PERCENT = 100
+HEAL_RANGE = 64  # px
 
 HUMAN_SIZE = (40, 75)
 
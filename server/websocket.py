@@ -6,20 +6,25 @@ import logging
 import json
 from collections import OrderedDict
 
-import gevent
 from gevent import monkey; monkey.patch_all()  # noqa
 from gevent.queue import Queue
-from geventwebsocket import (
-    WebSocketServer, WebSocketApplication, Resource, WebSocketError)
+from geventwebsocket import WebSocketServer, WebSocketApplication, Resource
 
 from conf import settings
 from utils import setup_logging
 from db import local_db
-from app.models import CharacterModel, Outlander, Turret
-from app.engine import spatial_hash, TiledReader
+from app.models import CharacterModel, Outlander, Turret, write_behind
+from app.engine import (
+    spatial_hash, game_loop, movement, planner, flow_fields, projectiles,
+    world, TiledReader)
+from app.network import (
+    ClientChannel, ClientInterest, InterestIndex, SnapshotHistory)
 
 
 main_queue = Queue()
+connections = set()
+history = SnapshotHistory()
+interest_index = InterestIndex()
 
 
 class GameApplication(WebSocketApplication):
@@ -32,18 +37,34 @@ class GameApplication(WebSocketApplication):
             del local_db['characters'][user.id]
         except KeyError:
             pass
+        write_behind.flush()
 
     def broadcast(self, msg_type, data):
-        try:
-            self.ws.send(json.dumps({'msg_type': msg_type, 'data': data}))
-        except WebSocketError as e:
-            GameApplication._g_cleaner(self.user)
-            logging.error(e)
+        self.channel.push(json.dumps({'msg_type': msg_type, 'data': data}))
+
+    def _on_channel_error(self):
+        connections.discard(self)
+        user = getattr(self, 'user', None)
+        if user is not None:
+            GameApplication._g_cleaner(user)
 
     def on_open(self):
         local_db.setdefault('characters', set())
+        self.acked_seq = None
+        self.interest = ClientInterest()
+        self.channel = ClientChannel(self.ws, on_error=self._on_channel_error)
+        connections.add(self)
         logging.debug("Connection opened")
 
+    def on_close(self, reason):
+        connections.discard(self)
+        self.channel.close()
+        user = getattr(self, 'user', None)
+        if user is not None and user.id in local_db['characters']:
+            # same as leaving, the character stops and is written out
+            self.unregister_user(None)
+        logging.debug("Connection closed")
+
     def on_message(self, message):
         if message:
             message = json.loads(message)
@@ -70,6 +91,14 @@ class GameApplication(WebSocketApplication):
         except (TypeError, KeyError):
             pass
 
+    def snapshot_ack(self, message):
+        try:
+            seq = int(message['seq'])
+        except (TypeError, KeyError, ValueError):
+            return
+        if self.acked_seq is None or seq > self.acked_seq:
+            self.acked_seq = seq
+
     def player_move(self, message):
         self.user.move(message['point'])
 
@@ -111,33 +140,130 @@ def pre_loader():
     ])
 
 
+def world_state():
+    return {
+        'users': {
+            char.id: char.to_dict()
+            for char in local_db['characters'].values()
+        },
+        # turrets of the sleeping regions are taken as they fell asleep
+        'turrets': world.state(),
+    }
+
+
+def observe_interest(conn, seq):
+    """Entities visible for the connection, ``None`` means everything"""
+    user = getattr(conn, 'user', None)
+    if not settings.NETWORK['AOI'] or user is None:
+        return None, frozenset(), frozenset()
+    visible = interest_index.query(user.coords, conn.interest.radius(user))
+    entered, left = conn.interest.observe(seq, visible)
+    return visible, entered, left
+
+
+def send_snapshots(server):
+    # removals are part of the snapshot delta, no need for the queue
+    while not main_queue.empty():
+        main_queue.get_nowait()
+    seq = history.record(world_state())
+    if settings.NETWORK['AOI']:
+        interest_index.rebuild(history.state)
+    # clients with the same baseline and view share one encoded frame
+    frames = {}
+    for conn in list(connections):
+        base_seq = history.baseline(conn.acked_seq)
+        visible, _, _ = observe_interest(conn, seq)
+        base_visible = (conn.interest.at(base_seq)
+                        if visible is not None else None)
+        key = (base_seq, visible, base_visible)
+        frame = frames.get(key)
+        if frame is None:
+            data = dict(history.snapshot(*key), count=len(server.clients))
+            frame = frames[key] = json.dumps({
+                'msg_type': 'world_snapshot', 'data': data})
+        conn.channel.push_frame(frame)
+
+
+def send_users_map(server):
+    state = world_state()
+    removed = []
+    if not main_queue.empty():
+        removed.append(main_queue.get_nowait())
+    data = {
+        'ai': {
+            'turrets': list(state['turrets'].values()),
+            'remove': []
+        },
+        'users': {
+            'update': list(state['users'].values()),
+            'remove': removed
+        },
+        'count': len(server.clients),
+    }
+    if not settings.NETWORK['AOI']:
+        # the frame is identical for every client, so encode it only once
+        frame = json.dumps({'msg_type': 'users_map', 'data': data})
+        for conn in list(connections):
+            conn.channel.push_frame(frame)
+        return
+
+    interest_index.rebuild(state)
+    # clients with the same view share one encoded frame
+    frames = {}
+    for conn in list(connections):
+        visible, _, left = observe_interest(conn, None)
+        key = (visible, left)
+        frame = frames.get(key)
+        if frame is not None:
+            conn.channel.push_frame(frame)
+            continue
+        if visible is None:
+            conn_data = data
+        else:
+            sections = {'users': [], 'turrets': []}
+            for section, eid in visible:
+                sections[section].append(state[section][eid])
+            gone = {'users': list(removed), 'turrets': []}
+            for section, eid in left:
+                gone[section].append(eid)
+            conn_data = {
+                'ai': {
+                    'turrets': sections['turrets'],
+                    'remove': gone['turrets']
+                },
+                'users': {
+                    'update': sections['users'],
+                    'remove': gone['users']
+                },
+                'count': data['count'],
+            }
+        frame = frames[key] = json.dumps({
+            'msg_type': 'users_map', 'data': conn_data})
+        conn.channel.push_frame(frame)
+
+
 def main_ticker(server):
     pre_loader()
-    while True:
-        gevent.sleep(0.01)
-        data = {
-            'ai': {
-                'turrets': Turret.get_all()
-            },
-            'users': {
-                'update': [
-                    char.to_dict()
-                    for char in local_db['characters'].values()
-                ],
-                'remove': []
-            },
-            'count': len(server.clients),
-        }
-        if not main_queue.empty():
-            result = main_queue.get_nowait()
-            data['users']['remove'].append(result)
-
-        for client in server.clients.values():
-            try:
-                client.ws.send(json.dumps({
-                    'msg_type': 'users_map', 'data': data}))
-            except WebSocketError:
-                pass
+
+    def broadcast(dt):
+        if settings.NETWORK['SNAPSHOTS'] == 'delta':
+            send_snapshots(server)
+        else:
+            send_users_map(server)
+
+    game_loop.add_phase('simulation', settings.GAME['FPS'],
+                        settings.GAME['TICK_POLICY'])
+    game_loop.add_phase('broadcast', settings.NETWORK['BROADCAST_RATE'])
+    planner.start()
+    game_loop.add_system('simulation', planner.update)
+    game_loop.add_system('simulation', movement.update)
+    game_loop.add_system('simulation', flow_fields.update)
+    game_loop.add_system('simulation', world.update)
+    game_loop.add_system('simulation', Turret.update_all)
+    game_loop.add_system('simulation', projectiles.update)
+    game_loop.add_system('simulation', write_behind.flush)
+    game_loop.add_system('broadcast', broadcast)
+    game_loop.run()
 
 
 if __name__ == '__main__':
@@ -160,3 +286,6 @@ if __name__ == '__main__':
         server.serve_forever()
     except KeyboardInterrupt:
         logging.info('Killing server...\n')
+    finally:
+        write_behind.flush()
+        planner.stop()